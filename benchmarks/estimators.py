@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the stabilisation estimators on synthetic noisy weigh-in traces.
+
+Usage (from the project root):
+    python benchmarks/estimators.py [--traces N] [--seed S]
+
+Every trace is a constant weight with load cell noise, slow sway and short shifts of the user's weight (wobbles). The
+report lists, per estimator, how many traces stabilised, the mean number of samples until the weight was declared
+stable and the mean and worst absolute error of the logged weight.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os.path
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wii_fit_bt_weight_tracker.pipeline import StabiliseStage  # noqa: E402
+from wii_fit_bt_weight_tracker.utils.estimators import ESTIMATORS  # noqa: E402
+
+TRACE_LENGTH = 5000
+
+
+def noisy_trace(random, weight):
+    """ Returns a raw (1/100 kg) total weight trace """
+    samples = numpy.arange(TRACE_LENGTH)
+    trace = weight + random.normal(0, 8, TRACE_LENGTH) + 6 * numpy.sin(samples / 40.0)
+    # Wobbles: short shifts of a few kilograms every few hundred samples
+    for start in random.randint(0, TRACE_LENGTH, TRACE_LENGTH // 300):
+        trace[start:start + random.randint(5, 30)] += random.choice((-1, 1)) * random.uniform(150, 500)
+    return trace
+
+
+def run(estimator, trace):
+    """ Returns (samples until stable, logged raw weight) or (None, None) if the trace never stabilised """
+    stage = StabiliseStage(settle_time=0, max_time_to_measure=float('inf'), max_samples=TRACE_LENGTH,
+                           estimator=estimator)
+    stage.reset()
+    for sample_number, sample in enumerate(trace):
+        reading = stage.process(sample)
+        if reading is not None:
+            return sample_number + 1, reading[0]
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare stabilisation estimators on synthetic noisy traces')
+    parser.add_argument('--traces', type=int, default=50, help='Number of traces to run every estimator on')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the traces')
+    args = parser.parse_args()
+
+    random = numpy.random.RandomState(args.seed)
+    weights = random.uniform(4000, 12000, args.traces)
+    traces = [noisy_trace(random, weight) for weight in weights]
+
+    print('{:<14} {:>10} {:>16} {:>15} {:>15}'.format('estimator', 'stable', 'samples (mean)', 'error kg (mean)',
+                                                      'error kg (max)'))
+    for estimator in sorted(ESTIMATORS):
+        samples, errors = list(), list()
+        for weight, trace in zip(weights, traces):
+            samples_until_stable, logged_weight = run(estimator, trace)
+            if samples_until_stable is None:
+                continue
+            samples.append(samples_until_stable)
+            errors.append(abs(logged_weight - weight) / 100.0)
+        if not samples:
+            print('{:<14} {:>10}'.format(estimator, '0/{}'.format(args.traces)))
+            continue
+        print('{:<14} {:>10} {:>16.0f} {:>15.3f} {:>15.3f}'.format(
+            estimator, '{}/{}'.format(len(samples), args.traces), numpy.mean(samples), numpy.mean(errors),
+            numpy.max(errors)
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Local TLS stand-in for the FitBit API used by the benchmarks, so the real FitBit client (OAuth2 session, shared
+connection pool, timeouts) can be exercised without network access or a FitBit account.
+
+The stand-in accepts weight logs, serves them back from the weight log endpoint, refreshes tokens and counts requests
+and TLS connections. It can be told to reject a share of the weight logs (HTTP 500) or to hang without responding.
+A self-signed certificate for 127.0.0.1 is created with the openssl command and trusted through REQUESTS_CA_BUNDLE.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os.path
+import random
+import re
+import ssl
+import subprocess
+import threading
+import time
+from collections import defaultdict
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs
+
+import fitbit_sync.fitbit_oauth_user_client as fitbit_client_module
+import fitbit_sync.user as fitbit_user
+from fitbit_sync.fitbit_oauth_user_client import FitBitOAuth2UserClient
+
+WEIGHT_LOG_PATH = '/1/user/-/body/log/weight.json'
+WEIGHT_LOGS_PATH = re.compile(r'^/1/user/-/body/log/weight/date/(\d{4}-\d{2}-\d{2})/(\d{4}-\d{2}-\d{2})\.json$')
+TOKEN_PATH = '/oauth2/token'
+
+
+def create_certificate(directory):
+    """ Creates a self-signed certificate for 127.0.0.1, returns (certificate file, key file) """
+    certificate_file = os.path.join(directory, 'fake_fitbit.crt')
+    key_file = os.path.join(directory, 'fake_fitbit.key')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+            '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key_file, '-out', certificate_file
+        ], stdout=devnull, stderr=devnull)
+    return certificate_file, key_file
+
+
+def create_token(number):
+    return {
+        'access_token': 'access-{}'.format(number),
+        'refresh_token': 'refresh-{}'.format(number),
+        'token_type': 'Bearer',
+        'expires_in': 28800,
+        'expires_at': time.time() + 28800,
+        'scope': ['weight'],
+    }
+
+
+class FakeFitBitHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so connection reuse by the client can be measured
+    disable_nagle_algorithm = True  # Headers and body are written separately, don't wait for the ACK in between
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8')
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _hang(self):
+        """ Doesn't respond until released (or the client gave up long ago) """
+        if self.server.hanging:
+            self.server.count('hung_requests')
+            self.server.released.wait(600)
+            return True
+        return False
+
+    def do_GET(self):
+        self.server.count('requests')
+        if self._hang():
+            return
+        match = WEIGHT_LOGS_PATH.match(self.path)
+        if not match:
+            self._respond(404, {'errors': [{'errorType': 'not_found'}]})
+            return
+        start, end = match.groups()
+        with self.server.lock:
+            weights = [entry for entry in self.server.weights if start <= entry['date'] <= end]
+        self._respond(200, {'weight': weights})
+
+    def do_POST(self):
+        self.server.count('requests')
+        body = parse_qs(self._read_body())
+        if self._hang():
+            return
+        if self.path == TOKEN_PATH:
+            self.server.count('token_refreshes')
+            self._respond(200, create_token(self.server.count('tokens')))
+        elif self.path == WEIGHT_LOG_PATH:
+            if self.server.random.uniform(0, 1) < self.server.failure_rate:
+                self.server.count('rejected_uploads')
+                self._respond(500, {'errors': [{'errorType': 'system'}]})
+                return
+            entry = {'weight': float(body['weight'][0]), 'date': body['date'][0], 'time': body['time'][0]}
+            if self.server.keep_weights:
+                with self.server.lock:
+                    self.server.weights.append(entry)
+            self.server.count('uploads')
+            self._respond(201, {'weightLog': entry})
+        else:
+            self._respond(404, {'errors': [{'errorType': 'not_found'}]})
+
+
+class FakeFitBitAPI(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, certificate_file, key_file, failure_rate=0.0, keep_weights=True, seed=1):
+        """
+        @type failure_rate: float
+        @param failure_rate: (optional) share of the weight logs rejected with HTTP 500
+        @type keep_weights: bool
+        @param keep_weights: (optional) whether to keep the logged weights to serve them back, long runs in the same
+                             process (see soak.py) only count them so the stand-in doesn't grow
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeFitBitHandler)
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(certificate_file, key_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.url = 'https://127.0.0.1:{}'.format(self.server_address[1])
+        self.failure_rate = failure_rate
+        self.keep_weights = keep_weights
+        self.random = random.Random(seed)
+        self.hanging = False
+        self.released = threading.Event()
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.weights = list()  # Weight log entries as returned by FitBit
+        self.thread = threading.Thread(name='Fake FitBit API', target=self.serve_forever)
+        self.thread.setDaemon(True)
+
+    def handle_error(self, request, client_address):
+        pass  # Clients giving up on hanging requests close their connections
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+            return self.counters[counter]
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def hang(self):
+        """ Stops responding until resume is called """
+        self.released.clear()
+        self.hanging = True
+
+    def resume(self):
+        self.hanging = False
+        self.released.set()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.resume()
+        self.shutdown()
+        self.server_close()
+
+
+def use_fake_fitbit(api, certificate_file):
+    """ Points the FitBit client at the stand-in and trusts its certificate """
+    os.environ['REQUESTS_CA_BUNDLE'] = certificate_file
+    FitBitOAuth2UserClient.API_ENDPOINT = api.url
+    FitBitOAuth2UserClient.request_token_url = '{}{}'.format(api.url, TOKEN_PATH)
+    FitBitOAuth2UserClient.access_token_url = FitBitOAuth2UserClient.request_token_url
+    FitBitOAuth2UserClient.refresh_token_url = FitBitOAuth2UserClient.request_token_url
+    FitBitOAuth2UserClient.client_id = 'benchmark'
+    FitBitOAuth2UserClient.client_secret = 'benchmark'
+    fitbit_client_module.FITBIT_SYNC_ENABLED = True
+
+
+def create_linked_users(users):
+    """ Creates FitBit users 1..users with stored tokens (fitbit_sync.user.user_data_file_location has to be set) """
+    for number in range(users):
+        user_id = fitbit_user.create_new_fitbit_user('benchmark-{}'.format(number + 1))
+        user = fitbit_user.FitBitUser(user_id)
+        user.user_token = create_token('user-{}'.format(user_id))
+        user.store_user_data()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the FitBit connection pool and timeouts against a local TLS stand-in of the FitBit API (see fake_fitbit.py).
+
+Usage (from the project root):
+    python benchmarks/fitbit_http.py [--users N] [--weights N] [--passes N] [--connect-timeout S] [--read-timeout S]
+
+Runs in a temporary directory (the real weight log and user data are never touched) with the real FitBit client and
+synchronisation loop:
+    - keep-alive: every pass logs new weights of every user and runs a synchronisation pass, the report lists the
+      requests and the TLS connections opened per pass. Connections should only be opened in the first pass and never
+      more than FITBIT_HTTP_POOL_SIZE.
+    - hanging server: the stand-in stops responding, the synchronisation pass has to give up after the read timeout
+      (every user reconciles and uploads, so at most two timeouts per user and FITBIT_SYNC_THREADS users at a time)
+    - recovery: the stand-in responds again and the next pass uploads the weights that timed out
+The timeouts default to FITBIT_HTTP_CONNECT_TIMEOUT_SECS and FITBIT_HTTP_READ_TIMEOUT_SECS, lower --read-timeout for a
+shorter run. Exits with a non-zero status if connections aren't reused, a pass hangs longer than the timeouts allow or
+weights are lost.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import math
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitbit_sync.fitbit_oauth_user_client as fitbit_client_module  # noqa: E402
+import fitbit_sync.outbox as outbox_module  # noqa: E402
+import fitbit_sync.user as fitbit_user  # noqa: E402
+import weight_logger.weight_logger as weight_logger_module  # noqa: E402
+from config import (  # noqa: E402
+    FITBIT_HTTP_CONNECT_TIMEOUT_SECS, FITBIT_HTTP_POOL_SIZE, FITBIT_HTTP_READ_TIMEOUT_SECS, FITBIT_SYNC_THREADS
+)
+from fake_fitbit import FakeFitBitAPI, create_certificate, create_linked_users, use_fake_fitbit  # noqa: E402
+from fitbit_sync.outbox import SyncOutbox  # noqa: E402
+from fitbit_sync.weight_sync import get_pending_syncs, sync_pending_weights  # noqa: E402
+from weight_logger.weight_logger import WeightLogger  # noqa: E402
+
+TIMEOUT_MARGIN_SECS = 1.0  # Allowed on top of the timeouts for the work around the requests
+
+
+class SyncBenchmark:
+    """ Weight log, outbox and clients of the synchronisation thread """
+
+    def __init__(self, users):
+        self.users = users
+        self.weight_logger = weight_logger_module.shared_weight_logger = WeightLogger(sync_enabled=True)
+        self.outbox = SyncOutbox()
+        self.pool = ThreadPool(FITBIT_SYNC_THREADS)
+        self.clients = {}
+        self.timestamp = int(time.time()) - 30 * 24 * 3600
+        self.logged = 0
+
+    def log_weights(self, weights):
+        """ Logs weights of every user, the users are told apart by their weight """
+        for _ in range(weights):
+            for user in range(self.users):
+                self.timestamp += 600
+                self.weight_logger.log_weight(50.0 + user * 20.0 + (self.logged % 10) * 0.1, self.timestamp, 0)
+                self.logged += 1
+
+    def run_pass(self):
+        """ One loop of the synchronisation thread, returns the seconds it took """
+        start = time.time()
+        self.weight_logger.refresh()
+        self.outbox.enqueue(self.weight_logger.get_unsynced_weight_data())
+        pending_syncs = get_pending_syncs(self.outbox, self.clients)
+        sync_pending_weights(self.weight_logger, self.outbox, self.pool, self.clients, pending_syncs)
+        return time.time() - start
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def counter_deltas(api, before):
+    after = api.get_counters()
+    return dict((name, after.get(name, 0) - before.get(name, 0)) for name in after)
+
+
+def run_keep_alive(benchmark, api, passes, weights, errors):
+    print('Keep-alive ({} users, {} weights per user and pass, pool of {} connections):'.format(
+        benchmark.users, weights, FITBIT_HTTP_POOL_SIZE))
+    print('{:>6} {:>9} {:>12} {:>9}'.format('pass', 'requests', 'connections', 'time(ms)'))
+    start_counters = api.get_counters()
+    for number in range(1, passes + 1):
+        before = api.get_counters()
+        benchmark.log_weights(weights)
+        elapsed = benchmark.run_pass()
+        deltas = counter_deltas(api, before)
+        print('{:>6} {:>9} {:>12} {:>9.1f}'.format(
+            number, deltas.get('requests', 0), deltas.get('connections', 0), elapsed * 1000))
+    deltas = counter_deltas(api, start_counters)
+    requests, connections = deltas.get('requests', 0), deltas.get('connections', 0)
+    print('{} requests over {} connections ({:.1f} requests per connection)'.format(
+        requests, connections, float(requests) / max(connections, 1)))
+    if connections > FITBIT_HTTP_POOL_SIZE:
+        errors.append('{} connections were opened, the pool holds {}'.format(connections, FITBIT_HTTP_POOL_SIZE))
+
+
+def run_hanging_server(benchmark, api, read_timeout, errors):
+    print('Hanging server (read timeout {:.1f}s):'.format(read_timeout))
+    benchmark.log_weights(1)
+    before = api.get_counters()
+    api.hang()
+    elapsed = benchmark.run_pass()
+    api.resume()
+    deltas = counter_deltas(api, before)
+    # Every user reconciles and uploads, each request waits for the read timeout
+    rounds = int(math.ceil(benchmark.users / float(FITBIT_SYNC_THREADS)))
+    bound = rounds * 2 * read_timeout + TIMEOUT_MARGIN_SECS
+    last_errors = sorted(set(record['last_error'] for record in benchmark.outbox.records.values()
+                             if record['last_error']))
+    print('  pass gave up after {:.2f}s (bound {:.2f}s), {} hung requests'.format(
+        elapsed, bound, deltas.get('hung_requests', 0)))
+    for error in last_errors:
+        print('  last error: {}'.format(error))
+    if elapsed > bound:
+        errors.append('the pass against the hanging server took {:.2f}s, the timeouts allow {:.2f}s'.format(
+            elapsed, bound))
+    if len(benchmark.outbox) != benchmark.users:
+        errors.append('{} weights pending after the hanging pass, expected {}'.format(
+            len(benchmark.outbox), benchmark.users))
+
+
+def run_recovery(benchmark, api, errors):
+    print('Recovery:')
+    before = api.get_counters()
+    elapsed = benchmark.run_pass()
+    deltas = counter_deltas(api, before)
+    print('  pass took {:.1f}ms, {} requests, {} new connections'.format(
+        elapsed * 1000, deltas.get('requests', 0), deltas.get('connections', 0)))
+    if len(benchmark.outbox):
+        errors.append('{} weights were not uploaded after the server recovered'.format(len(benchmark.outbox)))
+    uploads = api.get_counters().get('uploads', 0)
+    if uploads != benchmark.logged:
+        errors.append('{} weights were uploaded, {} were logged'.format(uploads, benchmark.logged))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the FitBit connection pool and timeouts')
+    parser.add_argument('--users', type=int, default=4, help='Number of linked FitBit users')
+    parser.add_argument('--weights', type=int, default=5, help='Weights logged per user before every pass')
+    parser.add_argument('--passes', type=int, default=5, help='Number of synchronisation passes')
+    parser.add_argument('--connect-timeout', type=float, default=FITBIT_HTTP_CONNECT_TIMEOUT_SECS,
+                        help='Connect timeout in seconds')
+    parser.add_argument('--read-timeout', type=float, default=FITBIT_HTTP_READ_TIMEOUT_SECS,
+                        help='Read timeout in seconds')
+    args = parser.parse_args()
+
+    # Failed uploads are logged as errors, only the report is of interest
+    logging.basicConfig(level=logging.CRITICAL)
+    directory = tempfile.mkdtemp(prefix='wiifitboardbit-fitbit-http-')
+    WeightLogger.weight_log_directory = os.path.join(directory, 'weight')
+    WeightLogger.legacy_weight_log_file = os.path.join(directory, 'weight.csv')
+    SyncOutbox.outbox_file = os.path.join(directory, 'outbox.json')
+    fitbit_user.user_data_file_location = directory
+    fitbit_client_module.HTTP_TIMEOUT = (args.connect_timeout, args.read_timeout)
+    outbox_module.FITBIT_SYNC_RETRY_DELAY_SECS = 0  # Weights that timed out are retried on the next pass
+    errors = list()
+    api = None
+    try:
+        certificate_file, key_file = create_certificate(directory)
+        api = FakeFitBitAPI(certificate_file, key_file)
+        api.start()
+        use_fake_fitbit(api, certificate_file)
+        create_linked_users(args.users)
+
+        benchmark = SyncBenchmark(args.users)
+        run_keep_alive(benchmark, api, args.passes, args.weights, errors)
+        run_hanging_server(benchmark, api, args.read_timeout, errors)
+        run_recovery(benchmark, api, errors)
+        benchmark.close()
+    finally:
+        if api:
+            api.stop()
+        weight_logger_module.shared_weight_logger = None
+        shutil.rmtree(directory)
+
+    if errors:
+        print('FAILED')
+        for error in errors:
+            print('  {}'.format(error))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Import time report of the WiiFitBoardBit subsystems.
+
+Usage (from the project root):
+    python benchmarks/import_time.py [--top N]
+
+Every module is imported in a fresh interpreter so the times are cold import times (excluding interpreter start up).
+On Python 3.7+ the slowest imports of the entry point are also listed using `-X importtime`.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os.path
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    'config',
+    'main',
+    'weight_logger.weight_logger',
+    'wii_fit_bt_weight_tracker.tracker',
+    'wii_fit_bt_weight_tracker.process',
+    'fitbit_sync.fitbit_oauth_user_client',
+    'fitbit_sync.weight_sync',
+    'fitbit_sync.webserver',
+]
+
+TIMING_SNIPPET = """
+import time
+start = time.time()
+import {}
+print('{{:.1f}}'.format((time.time() - start) * 1000))
+"""
+
+
+def measure_import(module):
+    """ Returns the cold import time of the module in milliseconds or the error if it can't be imported """
+    process = subprocess.Popen(
+        [sys.executable, '-c', TIMING_SNIPPET.format(module)],
+        cwd=PROJECT_ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    out, err = process.communicate()
+    if process.returncode != 0:
+        return None, err.strip().splitlines()[-1]
+    return float(out.strip()), None
+
+
+def slowest_imports(module, top):
+    """ Returns the (cumulative microseconds, module) of the slowest imports reported by -X importtime """
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        cwd=PROJECT_ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    _, err = process.communicate()
+    imports = list()
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.strip()))
+    imports.sort(reverse=True)
+    return imports[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report cold import times of the WiiFitBoardBit subsystems')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports of main to list')
+    args = parser.parse_args()
+
+    print('Cold import times ({})'.format(sys.version.split()[0]))
+    for module in MODULES:
+        import_time, error = measure_import(module)
+        if error:
+            print('  {:<40} failed: {}'.format(module, error))
+        else:
+            print('  {:<40} {:>8.1f} ms'.format(module, import_time))
+
+    if sys.version_info >= (3, 7):
+        print('\nSlowest imports of main (cumulative)')
+        for cumulative, name in slowest_imports('main', args.top):
+            print('  {:<40} {:>8.1f} ms'.format(name, cumulative / 1000.0))
+
+
+if __name__ == "__main__":
+    main()
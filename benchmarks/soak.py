@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Soak test of the long running loops: thousands of simulated weigh-ins and FitBit synchronisation cycles, checking
+that memory, file descriptors and threads stay bounded.
+
+Usage (from the project root):
+    python benchmarks/soak.py [--weigh-ins N] [--users N] [--sync-every N] [--report-every N] [--warm-up N]
+                              [--max-rss-growth-mb MB] [--seed S]
+
+Runs in a temporary directory (the real weight log and user data are never touched):
+    - board samples of several users go through the same pipeline the tracker uses (calibration, decimation,
+      stabilisation, unit conversion) and its sinks (weight log, local broker, file), the weigh-ins are spread over
+      the past years so weight log segments keep being rolled over and compacted
+    - every few weigh-ins a synchronisation cycle uploads the unsynced weights with the real FitBit client to a local
+      TLS stand-in of the FitBit API (see fake_fitbit.py). The stand-in rejects some uploads, so failed uploads,
+      retries and rebuilt clients (OAuth2 sessions mounting the shared connection pool) are exercised as well
+    - the web server queries (latest weights, full history summaries) run after every synchronisation cycle
+The RSS, open file descriptors, threads and traced Python memory are reported periodically. After the warm-up the
+growth is checked against the limits and the biggest growing allocations (tracemalloc, Python 3 only) are listed.
+Exits with a non-zero status if resources keep growing or weigh-ins were lost. Requires the openssl command.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import logging
+import os.path
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitbit_sync.outbox as outbox_module  # noqa: E402
+import fitbit_sync.user as fitbit_user  # noqa: E402
+import weight_logger.weight_logger as weight_logger_module  # noqa: E402
+from config import FITBIT_SYNC_THREADS  # noqa: E402
+from fake_fitbit import FakeFitBitAPI, create_certificate, create_linked_users, use_fake_fitbit  # noqa: E402
+from fitbit_sync.outbox import SyncOutbox  # noqa: E402
+from fitbit_sync.weight_sync import get_pending_syncs, sync_pending_weights  # noqa: E402
+from weight_logger.weight_logger import WeightLogger, get_weight_logger  # noqa: E402
+from wii_fit_bt_weight_tracker.pipeline import (  # noqa: E402
+    BrokerSink, CalibrationStage, DecimationStage, FileSink, LogWeighInStage, Stage, StabiliseStage,
+    UnitConversionStage, WeighInPipeline, WeightLoggerSink
+)
+
+SAMPLE_RATE_HZ = 100  # Event rate of the simulated board
+WEIGH_IN_INTERVAL_SECS = 8 * 3600  # Simulated time between weigh-ins
+FAILURE_RATE = 0.05  # Share of the uploads the FitBit stand-in rejects
+
+
+class SimulatedClock:
+    """ Time of the simulated board samples, advanced by every sample """
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += seconds
+
+
+class SimulatedTimeStage(Stage):
+    """ Moves the weigh-ins to the simulated time, so weigh-ins are logged over months instead of seconds """
+
+    name = 'simulated_time'
+
+    def __init__(self, start_timestamp):
+        self.timestamp = start_timestamp
+
+    def process(self, weigh_in):
+        self.timestamp += WEIGH_IN_INTERVAL_SECS
+        weigh_in['timestamp'] = self.timestamp
+        return weigh_in
+
+
+def board_samples(random, clock, weight):
+    """ Yields (top left, top right, bottom right, bottom left) raw samples of a user standing on the board """
+    while True:
+        clock.advance(1.0 / SAMPLE_RATE_HZ)
+        total = weight * 100 + random.normal(0, 8)
+        yield total * 0.26, total * 0.24, total * 0.26, total * 0.24
+
+
+def get_rss_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def get_open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def take_measurement(weigh_ins):
+    # Replaced clients form reference cycles (session -> token updater -> client), only count what can't be collected
+    gc.collect()
+    return {
+        'weigh_ins': weigh_ins,
+        'rss': get_rss_bytes(),
+        'fds': get_open_fds(),
+        'threads': threading.active_count(),
+        'traced': tracemalloc.get_traced_memory()[0] if tracemalloc else 0,
+    }
+
+
+def print_measurement(measurement, elapsed):
+    print('{:>9} {:>8.1f} {:>10.2f} {:>10.2f} {:>5} {:>8}'.format(
+        measurement['weigh_ins'], elapsed, measurement['rss'] / 1048576.0, measurement['traced'] / 1048576.0,
+        measurement['fds'], measurement['threads'])
+    )
+
+
+def run_sync_cycle(pipeline, outbox, pool, clients):
+    """ One loop of the synchronisation thread followed by the queries of the web server """
+    pipeline.join()
+    wl = get_weight_logger()
+    wl.refresh()
+    outbox.enqueue(wl.get_unsynced_weight_data())
+    pending_syncs = get_pending_syncs(outbox, clients)
+    sync_pending_weights(wl, outbox, pool, clients, pending_syncs)
+
+    wl.get_latest_weights_by_user()
+    history = wl.get_full_history()
+    for user_id in history.user_ids():
+        history.user_summary(user_id)
+
+
+def check_growth(baseline, final, max_rss_growth_mb, errors):
+    rss_growth_mb = (final['rss'] - baseline['rss']) / 1048576.0
+    if rss_growth_mb > max_rss_growth_mb:
+        errors.append('RSS grew by {:.2f}MB after the warm-up (limit {:.2f}MB)'.format(
+            rss_growth_mb, max_rss_growth_mb)
+        )
+    if final['fds'] > baseline['fds']:
+        errors.append('open file descriptors grew from {} to {}'.format(baseline['fds'], final['fds']))
+    if final['threads'] > baseline['threads']:
+        errors.append('threads grew from {} to {}'.format(baseline['threads'], final['threads']))
+
+
+def print_top_allocators(baseline_snapshot, limit=10):
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    print('Top growing allocations after the warm-up:')
+    for statistic in snapshot.compare_to(baseline_snapshot, 'lineno')[:limit]:
+        print('  {}'.format(statistic))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test the long running loops for memory and resource leaks')
+    parser.add_argument('--weigh-ins', type=int, default=2000, help='Number of simulated weigh-ins')
+    parser.add_argument('--users', type=int, default=3, help='Number of simulated users')
+    parser.add_argument('--sync-every', type=int, default=10, help='Weigh-ins between synchronisation cycles')
+    parser.add_argument('--report-every', type=int, default=200, help='Weigh-ins between resource reports')
+    parser.add_argument('--warm-up', type=int, default=400, help='Weigh-ins before the baseline is taken')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=8.0, help='Allowed RSS growth after the warm-up')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the weigh-ins')
+    args = parser.parse_args()
+
+    # The weigh-ins are logged at INFO level and the simulated FitBit failures as errors
+    logging.basicConfig(level=logging.CRITICAL)
+    random = numpy.random.RandomState(args.seed)
+    # Users far enough apart to be told apart by weight
+    user_weights = [55.0 + user * 20.0 for user in range(args.users)]
+
+    directory = tempfile.mkdtemp(prefix='wiifitboardbit-soak-')
+    WeightLogger.weight_log_directory = os.path.join(directory, 'weight')
+    WeightLogger.legacy_weight_log_file = os.path.join(directory, 'weight.csv')
+    SyncOutbox.outbox_file = os.path.join(directory, 'outbox.json')
+    fitbit_user.user_data_file_location = directory
+    outbox_module.FITBIT_SYNC_RETRY_DELAY_SECS = 0  # Failed uploads are retried on the next cycle
+    weight_logger_module.shared_weight_logger = WeightLogger(sync_enabled=True)
+    errors = list()
+    api = None
+    try:
+        certificate_file, key_file = create_certificate(directory)
+        api = FakeFitBitAPI(certificate_file, key_file, failure_rate=FAILURE_RATE, keep_weights=False)
+        api.start()
+        use_fake_fitbit(api, certificate_file)
+        create_linked_users(args.users)
+
+        clock = SimulatedClock()
+        start_timestamp = int(time.time()) - args.weigh_ins * WEIGH_IN_INTERVAL_SECS
+        pipeline = WeighInPipeline(
+            sample_stages=[
+                CalibrationStage(),
+                DecimationStage(25, clock=clock),
+                StabiliseStage(window=100, settle_time=0, max_time_to_measure=float('inf')),
+            ],
+            reading_stages=[UnitConversionStage(), SimulatedTimeStage(start_timestamp), LogWeighInStage()],
+            sinks=[WeightLoggerSink(), BrokerSink(), FileSink(os.path.join(directory, 'weigh_ins.jsonl'))]
+        )
+        outbox = SyncOutbox()
+        pool = ThreadPool(FITBIT_SYNC_THREADS)
+        clients = {}
+
+        if tracemalloc:
+            tracemalloc.start()
+        print('{:>9} {:>8} {:>10} {:>10} {:>5} {:>8}'.format(
+            'weigh-ins', 'time(s)', 'RSS(MB)', 'traced(MB)', 'fds', 'threads'))
+        start = time.time()
+        baseline, baseline_snapshot = None, None
+        for weigh_in in range(1, args.weigh_ins + 1):
+            weight = user_weights[random.randint(len(user_weights))] + random.uniform(-1, 1)
+            pipeline.publish(pipeline.measure(board_samples(random, clock, weight)))
+            if weigh_in % args.sync_every == 0:
+                run_sync_cycle(pipeline, outbox, pool, clients)
+            if weigh_in == args.warm_up:
+                run_sync_cycle(pipeline, outbox, pool, clients)
+                baseline = take_measurement(weigh_in)
+                baseline_snapshot = tracemalloc.take_snapshot() if tracemalloc else None
+            if weigh_in % args.report_every == 0:
+                print_measurement(take_measurement(weigh_in), time.time() - start)
+
+        # Retry until the failed uploads went through as well
+        for _ in range(10):
+            run_sync_cycle(pipeline, outbox, pool, clients)
+        final = take_measurement(args.weigh_ins)
+        print_measurement(final, time.time() - start)
+
+        if baseline is None:
+            errors.append('the warm-up ({} weigh-ins) is longer than the soak test'.format(args.warm_up))
+        else:
+            check_growth(baseline, final, args.max_rss_growth_mb, errors)
+            if baseline_snapshot:
+                print_top_allocators(baseline_snapshot)
+
+        wl = WeightLogger(sync_enabled=True)
+        logged = len(wl.get_all_weights())
+        if logged != args.weigh_ins:
+            errors.append('expected {} logged weights, found {}'.format(args.weigh_ins, logged))
+        if wl.get_unsynced_weight_data() or len(outbox):
+            errors.append('{} weights were not synchronised'.format(len(wl.get_unsynced_weight_data())))
+        counters = api.get_counters()
+        uploads = counters.get('uploads', 0)
+        if uploads != args.weigh_ins:
+            errors.append('{} weights were uploaded, expected {}'.format(uploads, args.weigh_ins))
+        pool.close()
+        pool.join()
+    finally:
+        if api:
+            api.stop()
+        weight_logger_module.shared_weight_logger = None
+        shutil.rmtree(directory)
+
+    print('{} weigh-ins, {} uploads ({} rejected) in {} requests over {} connections to the FitBit stand-in'.format(
+        args.weigh_ins, uploads, counters.get('rejected_uploads', 0), counters.get('requests', 0),
+        counters.get('connections', 0))
+    )
+    if errors:
+        print('FAILED')
+        for error in errors:
+            print('  {}'.format(error))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == "__main__":
+    main()
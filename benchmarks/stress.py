@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Stress test of the state shared between the tracking, logging, web server and synchronisation threads.
+
+Usage (from the project root):
+    python benchmarks/stress.py [--threads N] [--weigh-ins N]
+
+Runs in a temporary directory (the real weight log and user data are never touched):
+    - weigh-in threads log weights through the shared WeightLogger, others through their own WeightLogger instances
+      (like the bulk import command running next to WiiFitBoardBit)
+    - a synchronisation thread keeps marking the unsynced weights as synced
+    - reader threads keep querying the history (like the web server)
+    - user threads keep storing different fields of the same FitBit user (like the web server storing a CSRF token
+      while the synchronisation thread refreshes the token)
+Afterwards the weight log and the user data file are read back and checked for lost, duplicated or corrupted entries.
+Exits with a non-zero status if any check fails.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitbit_sync.user as fitbit_user  # noqa: E402
+import weight_logger.weight_logger as weight_logger_module  # noqa: E402
+from weight_logger.weight_logger import WeightLogger, format_weight, get_weight_logger  # noqa: E402
+
+USER_ID = 1
+
+
+def log_weights(thread_number, weigh_ins, shared, errors):
+    try:
+        weight_logger = get_weight_logger() if shared else WeightLogger()
+        for weigh_in in range(weigh_ins):
+            # Every weigh-in has a unique weight so lost and duplicated entries can be told apart
+            weight_logger.log_weight(40 + thread_number * 2 + weigh_in * 0.01)
+    except Exception as exc:
+        errors.append('weigh-in thread {}: {}: {}'.format(thread_number, type(exc).__name__, exc))
+
+
+def sync_weights(running, errors, passes):
+    try:
+        weight_logger = get_weight_logger()
+        while running[0]:
+            weight_logger.refresh()
+            weight_logger.update_weight_sync_status(weight_logger.get_unsynced_weight_data())
+            passes[0] += 1
+    except Exception as exc:
+        errors.append('sync thread: {}: {}'.format(type(exc).__name__, exc))
+
+
+def read_history(running, errors):
+    try:
+        weight_logger = get_weight_logger()
+        while running[0]:
+            weight_logger.get_history().latest_indices_by_user()
+            weight_logger.get_latest_weights_by_user()
+    except Exception as exc:
+        errors.append('reader thread: {}: {}'.format(type(exc).__name__, exc))
+
+
+def store_user_field(field, updates, errors):
+    try:
+        for update in range(updates):
+            user = fitbit_user.FitBitUser(USER_ID)
+            if field == 'csrf_token':
+                user.csrf_token = 'csrf-{}'.format(update)
+            else:
+                user.user_token = {'access_token': 'token-{}'.format(update)}
+            user.store_user_data()
+    except Exception as exc:
+        errors.append('user thread ({}): {}: {}'.format(field, type(exc).__name__, exc))
+
+
+def check_weight_log(expected_weights, errors):
+    weight_logger = WeightLogger()
+    logged_weights = sorted(format_weight(weight['weight']) for weight in weight_logger.get_all_weights())
+    if len(logged_weights) != len(expected_weights):
+        errors.append('expected {} logged weights, found {}'.format(len(expected_weights), len(logged_weights)))
+    if len(set(logged_weights)) != len(logged_weights):
+        errors.append('{} weights were logged more than once'.format(len(logged_weights) - len(set(logged_weights))))
+    missing = set(expected_weights) - set(logged_weights)
+    if missing:
+        errors.append('{} weights were lost'.format(len(missing)))
+    weight_logger.update_weight_sync_status(weight_logger.get_unsynced_weight_data())
+    if WeightLogger().get_unsynced_weight_data():
+        errors.append('sync status was not stored for every weight')
+
+
+def check_user_data(updates, errors):
+    with open(fitbit_user.get_user_file_location(USER_ID)) as user_data_file:
+        user_data = json.load(user_data_file)
+    expected = {
+        'user_name': 'stress',
+        'csrf_token': 'csrf-{}'.format(updates - 1),
+        'token_data': {'access_token': 'token-{}'.format(updates - 1)},
+    }
+    for field, value in expected.items():
+        if user_data.get(field) != value:
+            errors.append('user data field {} is {!r}, expected {!r}'.format(field, user_data.get(field), value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress test the state shared between threads')
+    parser.add_argument('--threads', type=int, default=8, help='Number of weigh-in threads')
+    parser.add_argument('--weigh-ins', type=int, default=50, help='Weigh-ins logged by every thread (at most 100)')
+    args = parser.parse_args()
+    weigh_ins = min(args.weigh_ins, 100)
+
+    directory = tempfile.mkdtemp(prefix='wiifitboardbit-stress-')
+    WeightLogger.weight_log_directory = os.path.join(directory, 'weight')
+    WeightLogger.legacy_weight_log_file = os.path.join(directory, 'weight.csv')
+    fitbit_user.user_data_file_location = directory
+    errors = list()
+    try:
+        fitbit_user.create_new_fitbit_user('stress')
+
+        running, passes = [True], [0]
+        background = [Thread(target=sync_weights, args=(running, errors, passes))]
+        background.extend(Thread(target=read_history, args=(running, errors)) for _ in range(2))
+        workers = [
+            Thread(target=log_weights, args=(thread_number, weigh_ins, thread_number % 2 == 0, errors))
+            for thread_number in range(args.threads)
+        ]
+        workers.extend(Thread(target=store_user_field, args=(field, weigh_ins, errors))
+                       for field in ('csrf_token', 'token_data'))
+
+        start = time.time()
+        for thread in background + workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        running[0] = False
+        for thread in background:
+            thread.join()
+        elapsed = time.time() - start
+
+        expected_weights = [
+            format_weight(40 + thread_number * 2 + weigh_in * 0.01)
+            for thread_number in range(args.threads) for weigh_in in range(weigh_ins)
+        ]
+        check_weight_log(expected_weights, errors)
+        check_user_data(weigh_ins, errors)
+    finally:
+        weight_logger_module.shared_weight_logger = None
+        shutil.rmtree(directory)
+
+    print('{} weigh-ins from {} threads and {} sync passes in {:.2f}s'.format(
+        args.threads * weigh_ins, args.threads, passes[0], elapsed))
+    if errors:
+        print('FAILED')
+        for error in errors:
+            print('  {}'.format(error))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,29 @@ FITBIT_CLIENT_SECRET = None
 
 # How often to attempt weight logging on FitBit
 WEIGHT_SYNC_LOOP_TIME_SECS = 30
+
+# A weight that failed to upload is retried after FITBIT_SYNC_RETRY_DELAY_SECS, the delay doubles with every failed
+# attempt up to FITBIT_SYNC_MAX_RETRY_DELAY_SECS. After FITBIT_SYNC_MAX_ATTEMPTS failed attempts, or right away when
+# FitBit rejects the weight (HTTP 4xx), the weight is no longer retried and is kept in the outbox as failed.
+FITBIT_SYNC_RETRY_DELAY_SECS = 60
+FITBIT_SYNC_MAX_RETRY_DELAY_SECS = 6 * 3600
+FITBIT_SYNC_MAX_ATTEMPTS = 10
+
+# Before uploading, check which of the unsynced weights are already logged on FitBit (e.g. after the sync status in the
+# weight log was lost) and mark them as synced instead of logging them again.
+FITBIT_RECONCILE_WEIGHTS = True
+
+# Port and number of request threads of the FitBit authentication web server. The server runs on cheroot (a production
+# WSGI server) if it is installed (pip install cheroot) and falls back to the threaded werkzeug server otherwise.
+FITBIT_AUTH_SERVER_PORT = 443
+FITBIT_AUTH_SERVER_THREADS = 4
+
+# Number of users synchronised in parallel. Connections to FitBit are kept alive in a pool shared by all users, the pool
+# holds at most FITBIT_HTTP_POOL_SIZE connections. Requests time out after the timeouts bellow.
+FITBIT_SYNC_THREADS = 2
+FITBIT_HTTP_POOL_SIZE = 4
+FITBIT_HTTP_CONNECT_TIMEOUT_SECS = 5
+FITBIT_HTTP_READ_TIMEOUT_SECS = 15
 # ======================================================================================================================
 
 
@@ -46,11 +69,58 @@ ALLOWED_WEIGHT_FLUCTUATION_KG = 10.0
 # ======================================================================================================================
 
 
+# =================================================== Weigh-in Pipeline ================================================
+# Every weigh-in goes through the following stages:
+# board samples -> calibrate -> decimate -> stabilise -> unit convert -> sinks.
+# Calibration is applied to the sum of all load cells: weight * WEIGHT_CALIBRATION_SCALE + WEIGHT_CALIBRATION_OFFSET_KG
+WEIGHT_CALIBRATION_OFFSET_KG = 0.0
+WEIGHT_CALIBRATION_SCALE = 1.0
+
+# The board sends samples at an irregular rate, they are reduced to DECIMATION_RATE_HZ samples per second before
+# stabilisation so it behaves the same on every board and less work is done per sample. DECIMATION_FILTER is either
+# 'block' (average of the samples in every 1/DECIMATION_RATE_HZ seconds) or 'fir' (low-pass filter over the latest
+# block averages, smoother but reacts slightly later). Set DECIMATION_RATE_HZ to None to stabilise every raw sample.
+DECIMATION_RATE_HZ = 25
+DECIMATION_FILTER = 'block'
+# The weight is stable when the samples of the last STABILISATION_WINDOW_SECS seconds agree. Measuring gives up without
+# logging a weight when the weight isn't stable after STABILISATION_TIMEOUT_SECS seconds of decimated samples.
+STABILISATION_WINDOW_SECS = 4
+STABILISATION_TIMEOUT_SECS = 30
+
+# Estimator used to decide when the weight is stable and what weight to log:
+# 'mean' - mean and standard deviation of the latest samples
+# 'median' - rolling median, a single shift on the board barely affects it
+# 'mad' - mean of the latest samples after rejecting outliers (further than 3 median absolute deviations)
+# 'trimmed_mean' - mean of the latest samples without the 10% lowest and 10% highest samples
+STABILISATION_ESTIMATOR = 'mean'
+
+# Besides the weight log every weigh-in can also be sent to the following (optional) sinks
+WEIGH_IN_FILE_SINK_LOCATION = None  # File to append every weigh-in to as a line of JSON
+WEIGH_IN_HTTP_SINK_URL = None  # URL to POST every weigh-in to as JSON
+
+# Set to True to keep the board connected after a weigh-in so that several people can weigh themselves one after another
+# without pressing the button again. The next weigh-in starts when the previous user steps off and the next one steps on
+# (total weight above SESSION_STEP_THRESHOLD_KG). The board disconnects when nobody steps on (or off) the board for
+# SESSION_IDLE_TIMEOUT_SECS.
+MULTI_USER_SESSION_ENABLED = False
+SESSION_STEP_THRESHOLD_KG = 5.0
+SESSION_IDLE_TIMEOUT_SECS = 15
+
+# Set to True to measure in a separate process instead of a thread, so the web server and FitBit synchronisation can't
+# slow down measuring. Weigh-ins are sent to the main process which logs them. The tracking process is restarted after
+# TRACKER_RESTART_DELAY_SECS if it stops.
+TRACKER_PROCESS_ISOLATION = False
+TRACKER_RESTART_DELAY_SECS = 5
+# ======================================================================================================================
+
+
 # ======================================================= Other ========================================================
 # Various other settings, there should be no reason to change these
 UNITS = 'METRIC'  # Set 'METRIC' for kg, 'IMPERIAL' for pounds.
-DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # Sets the date format in which to store the weight
-WEIGHT_LOG_LOCATION = "data/weight.csv"  # Sets the weight file location
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # Sets the date format in which dates are shown and exported
+WEIGHT_LOG_SEGMENTS_LOCATION = "data/weight"  # Sets the weight log directory (one file per month)
+WEIGHT_LOG_LOCATION = "data/weight.csv"  # Weight file of older versions, split into the weight log directory on start
+SYNC_OUTBOX_LOCATION = "data/outbox.json"  # Sets the location of the weights waiting to be uploaded to FitBit
 LOG_LOCATION = 'log.txt'  # Sets the log file location for general system info and error output
 BALANCE_BOARD_MAC = None  # (optional) Can set your wii balance board MAC address if you already know it
 # ======================================================================================================================
@@ -1,5 +1 @@
-from . import utils
-from . import user
-from . import fitbit_oauth_user_client
-from . import webserver
-from . import weight_sync
+# Submodules are not imported here so that importing one of them doesn't pull in Flask and OAuth dependencies
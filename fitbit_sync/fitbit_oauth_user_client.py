@@ -2,13 +2,41 @@
 import json
 import logging
 import urllib
+from collections import defaultdict
+from datetime import date as datetime_date, datetime, timedelta
+from threading import Lock
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from requests_oauthlib import OAuth2Session
 
-from config import FITBIT_SYNC_ENABLED, FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET, UNITS
+from config import (
+    FITBIT_SYNC_ENABLED, FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET, FITBIT_HTTP_CONNECT_TIMEOUT_SECS,
+    FITBIT_HTTP_POOL_SIZE, FITBIT_HTTP_READ_TIMEOUT_SECS, UNITS
+)
 from fitbit_sync.user import FitBitUser
 from fitbit_sync.utils.compliance import fitbit_compliance_fix
+from weight_logger.timestamps import to_local_datetime
+
+# Weight logs fetched from FitBit by user id and day. Only past days are cached since today's log can still change
+weight_log_cache = defaultdict(dict)
+
+# Connection pool shared by the sessions of all users so that connections to FitBit are kept alive and reused
+shared_http_adapter = None
+shared_http_adapter_lock = Lock()
+
+HTTP_TIMEOUT = (FITBIT_HTTP_CONNECT_TIMEOUT_SECS, FITBIT_HTTP_READ_TIMEOUT_SECS)
+
+
+def get_shared_http_adapter():
+    """ Returns the HTTP adapter (urllib3 connection pool) shared by all user clients, creating it on first use """
+    global shared_http_adapter
+    with shared_http_adapter_lock:
+        if shared_http_adapter is None:
+            shared_http_adapter = HTTPAdapter(
+                pool_connections=FITBIT_HTTP_POOL_SIZE, pool_maxsize=FITBIT_HTTP_POOL_SIZE, pool_block=True
+            )
+    return shared_http_adapter
 
 
 class FitBitOAuth2UserClient:
@@ -30,15 +58,30 @@ class FitBitOAuth2UserClient:
     US = 'en_US'
     METRIC = 'en_UK'
 
+    MAX_WEIGHT_LOG_RANGE_DAYS = 31  # FitBit limits weight log requests to a 31 day range
+    WEIGHT_MATCH_TOLERANCE = 0.05  # FitBit can round the logged weights
+    WEIGHT_LOG_CACHE_DAYS = 62  # Days before today for which the weight logs are kept in cache
+
     def __init__(self, user_id):
         self.user_id = user_id
         self.user = FitBitUser(user_id)
         self.session = self._initiate_oauth_session()
+        self.last_error = None  # Reason the last weight could not be logged
+        self.last_error_permanent = False  # Whether FitBit rejected the last weight, retrying it won't help
 
     def is_authorised(self):
         """ Check if the app is authorised """
         return self._check_app_authorisation()
 
+    def is_linked(self):
+        """ Check if the user has linked a FitBit account (a token is stored) """
+        return bool(self.get_stored_token())
+
+    @staticmethod
+    def is_permanent_failure(status_code):
+        """ Client errors other than authentication, timeouts and rate limiting fail again when retried """
+        return 400 <= status_code < 500 and status_code not in (401, 408, 429)
+
     def _check_app_authorisation(self):
         """ Check if the FitBit App settings are set """
         if not FITBIT_SYNC_ENABLED:
@@ -59,6 +102,9 @@ class FitBitOAuth2UserClient:
             token_updater=self.do_store_token,
             scope=self.scope,
         ))
+        adapter = get_shared_http_adapter()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
         stored_token = self.get_stored_token()
         if stored_token:
             session.token = stored_token
@@ -78,19 +124,34 @@ class FitBitOAuth2UserClient:
             username=self.client_id,
             password=self.client_secret,
             client_secret=self.client_secret,
-            code=code)
+            code=code,
+            timeout=HTTP_TIMEOUT)
+        # Store the new token first so the refresh doesn't mistake the previously stored token for a newer one
+        self.do_store_token(self.session.token)
         self.do_refresh_token()
         return
 
     def do_refresh_token(self):
-        """ Refreshes access token based on user refresh token if needed """
+        """
+        Refreshes access token based on user refresh token if needed. Refresh tokens can only be used once, so the
+        token is refreshed under the user lock and a token stored by another client in the mean time is used instead.
+        """
         token = {}
         if self.session.token_updater:
-            token = self.session.refresh_token(
-                self.refresh_token_url,
-                auth=HTTPBasicAuth(self.client_id, self.client_secret),
-            )
-            self.session.token_updater(token)
+            with self.user.lock:
+                self.user = FitBitUser(self.user_id)  # Reload, another client may have stored a newer token
+                stored_token = self.get_stored_token()
+                session_token = self.session.token or {}
+                if stored_token and stored_token.get('refresh_token') != session_token.get('refresh_token'):
+                    logging.info("Using the token refreshed by another client for user {}".format(self.user_id))
+                    self.session.token = stored_token
+                    return stored_token
+                token = self.session.refresh_token(
+                    self.refresh_token_url,
+                    auth=HTTPBasicAuth(self.client_id, self.client_secret),
+                    timeout=HTTP_TIMEOUT,
+                )
+                self.session.token_updater(token)
         return token
 
     def do_store_token(self, token):
@@ -111,6 +172,32 @@ class FitBitOAuth2UserClient:
         url = '{}?{}'.format(self.authorization_url, urllib.urlencode(url_data))
         return url
 
+    def _get_session(self):
+        """ Returns the OAuth2 session (initiating it if needed) or False if the app is not authorised """
+        if not self.is_authorised():
+            return False
+        if not self.session:
+            self.session = self._initiate_oauth_session()
+        return self.session
+
+    def _request(self, method, url, **kwargs):
+        """ Sends a request to FitBit refreshing the access token once if it has expired """
+        request = {
+            'headers': {'Accept-Language': self.METRIC if UNITS == 'METRIC' else self.US},
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'timeout': HTTP_TIMEOUT,
+        }
+        request.update(kwargs)
+        response = self.session.request(method, url, **request)
+
+        if response.status_code == 401:
+            d = json.loads(response.content.decode('utf8'))
+            if d['errors'][0]['errorType'] == 'expired_token':
+                self.do_refresh_token()
+                response = self.session.request(method, url, **request)
+        return response
+
     def log_user_weight(self, weight, date):
         """
         Sends a POST request to FitBit to log user weight for the specified date
@@ -119,11 +206,9 @@ class FitBitOAuth2UserClient:
         @type date: datetime.datetime
         @param date: datetime object for which to store the date
         """
-        if not self.is_authorised():
-            return False
-        if not self.session:
-            self.session = self._initiate_oauth_session()
-        if not self.session:
+        self.last_error_permanent = False
+        if not self._get_session():
+            self.last_error = 'Not authorised'
             return False
 
         url = '{}/{}/user/-/body/log/weight.json'.format(self.API_ENDPOINT, self.API_VERSION)
@@ -134,31 +219,104 @@ class FitBitOAuth2UserClient:
             'time': date.strftime('%H:%M:%S'),
         }
 
-        method = 'POST'
-
-        request = {
-            'headers': {'Accept-Language': self.METRIC if UNITS == 'METRIC' else self.US},
-            'data': data,
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-        }
         try:
-            response = self.session.request(method, url, **request)
-
-            if response.status_code == 401:
-                d = json.loads(response.content.decode('utf8'))
-                if d['errors'][0]['errorType'] == 'expired_token':
-                    self.do_refresh_token()
-                    response = self.session.request(method, url, **request)
-
+            response = self._request('POST', url, data=data)
             success = response.status_code == 202 or response.status_code == 201
+            self.last_error = None if success else 'HTTP {}'.format(response.status_code)
+            self.last_error_permanent = self.is_permanent_failure(response.status_code)
         except Exception as e:
             success = False
+            self.last_error = '{}: {}'.format(type(e).__name__, e)
 
         if success:
+            # The cached log of that day no longer matches what is stored on FitBit
+            weight_log_cache[self.user_id].pop(date.date(), None)
             logging.info("Successfully logged weight {:.2f} for user {} on FitBit".format(weight, self.user.user_name))
         else:
             logging.info("Failed logging weight {:.2f} for user {}. Please check user authentication".format(
                 weight, self.user.user_name or self.user.user_id)
             )
         return success
+
+    def get_user_weight_logs(self, start_date, end_date):
+        """
+        Gets the weight logs of the user stored on FitBit for a date range. The range is requested in pages of at most
+        MAX_WEIGHT_LOG_RANGE_DAYS days and past days that were already fetched are served from cache.
+        @type start_date: datetime.date
+        @param start_date: first day (inclusive) to get the logs for
+        @type end_date: datetime.date
+        @param end_date: last day (inclusive) to get the logs for
+        @return (dict) datetime.date -> list of FitBit weight log entries or None if the logs could not be fetched
+        """
+        if not self._get_session():
+            return None
+        user_cache = weight_log_cache[self.user_id]
+        today = datetime_date.today()
+
+        logs = dict()
+        day = start_date
+        while day <= end_date:
+            if day in user_cache:
+                logs[day] = user_cache[day]
+                day += timedelta(days=1)
+                continue
+            page_end = min(day + timedelta(days=self.MAX_WEIGHT_LOG_RANGE_DAYS - 1), end_date)
+            url = '{}/{}/user/-/body/log/weight/date/{}/{}.json'.format(
+                self.API_ENDPOINT, self.API_VERSION, day.strftime('%Y-%m-%d'), page_end.strftime('%Y-%m-%d')
+            )
+            try:
+                response = self._request('GET', url)
+                if response.status_code != 200:
+                    raise ValueError('Unexpected response status {}'.format(response.status_code))
+                entries = json.loads(response.content.decode('utf8')).get('weight', [])
+            except Exception as exc:
+                logging.info("Failed getting FitBit weight logs for user {}: {}".format(self.user_id, exc))
+                return None
+
+            page_logs = defaultdict(list)
+            for entry in entries:
+                page_logs[datetime.strptime(entry['date'], '%Y-%m-%d').date()].append(entry)
+            while day <= page_end:
+                logs[day] = page_logs.get(day, [])
+                if day < today:
+                    user_cache[day] = logs[day]
+                day += timedelta(days=1)
+
+        # Drop old days so the cache doesn't keep growing while running for months
+        oldest_cached_day = today - timedelta(days=self.WEIGHT_LOG_CACHE_DAYS)
+        for cached_day in [cached_day for cached_day in user_cache if cached_day < oldest_cached_day]:
+            del user_cache[cached_day]
+        return logs
+
+    def reconcile_weights(self, weights):
+        """
+        Finds which of the weights are already logged on FitBit (same date, time and weight)
+        @type weights: list(dict)
+        @param weights: weight data of this user as stored by the WeightLogger
+        @return (list(dict)) weights that are already logged on FitBit
+        """
+        if not weights:
+            return []
+        # FitBit logs weights in the local time of the user
+        dates_logged = [
+            to_local_datetime(weight_data['timestamp'], weight_data['utc_offset']) for weight_data in weights
+        ]
+        logs = self.get_user_weight_logs(min(dates_logged).date(), max(dates_logged).date())
+        if not logs:
+            return []
+
+        logged_weights = defaultdict(list)
+        for log_day, entries in logs.items():
+            for entry in entries:
+                logged_weights[(log_day, entry.get('time'))].append(float(entry['weight']))
+
+        reconciled = list()
+        for weight_data, date_logged in zip(weights, dates_logged):
+            key = (date_logged.date(), date_logged.strftime('%H:%M:%S'))
+            logged = logged_weights.get(key, [])
+            if any(abs(weight - weight_data['weight']) < self.WEIGHT_MATCH_TOLERANCE for weight in logged):
+                reconciled.append(weight_data)
+        logging.info("Found {} out of {} weights already logged on FitBit for user {}".format(
+            len(reconciled), len(weights), self.user_id)
+        )
+        return reconciled
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import os.path
+import socket
+import time
+from collections import OrderedDict, defaultdict
+from inspect import getsourcefile
+
+from six.moves.urllib.parse import urlparse
+
+from config import (
+    FITBIT_SYNC_MAX_ATTEMPTS, FITBIT_SYNC_MAX_RETRY_DELAY_SECS, FITBIT_SYNC_RETRY_DELAY_SECS, SYNC_OUTBOX_LOCATION
+)
+from weight_logger.weight_logger import get_weight_key
+
+base_file = os.path.abspath(getsourcefile(lambda: 0))
+base_file_location = os.path.dirname(os.path.dirname(base_file))  # Project root, one level above this package
+
+
+def generate_idempotency_key(weight_data):
+    """ Generates the key identifying a weight upload, the same weight is never queued twice """
+    return get_weight_key(weight_data)
+
+
+def is_reachable(url, timeout=5):
+    """ Checks if a TCP connection can be opened to the host of the URL """
+    parsed_url = urlparse(url)
+    port = parsed_url.port or (443 if parsed_url.scheme == 'https' else 80)
+    try:
+        socket.create_connection((parsed_url.hostname, port), timeout).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+class SyncOutbox:
+    """
+    Persisted queue of weights waiting to be uploaded to FitBit. Every record keeps the number of upload attempts, the
+    last error and when to attempt the upload again. Records are kept in the order they were queued in. Weights that
+    are no longer retried stay in the outbox marked as failed, so they aren't queued again.
+    """
+
+    outbox_file = os.path.join(base_file_location, SYNC_OUTBOX_LOCATION)
+
+    def __init__(self):
+        self.records = self._read_records()
+
+    def _read_records(self):
+        records = OrderedDict()
+        if not os.path.isfile(self.outbox_file):
+            return records
+        with open(self.outbox_file) as outbox:
+            for record in json.load(outbox):
+                records[record['key']] = record
+        logging.info('[WSO] Found {} pending uploads in the outbox'.format(len(records)))
+        return records
+
+    def _store(self):
+        # Write to a temporary file first so an interrupted write never loses the outbox
+        temporary_file = '{}.tmp'.format(self.outbox_file)
+        with open(temporary_file, 'w') as outbox:
+            json.dump(list(self.records.values()), outbox)
+        os.rename(temporary_file, self.outbox_file)
+
+    def __len__(self):
+        """ Number of weights still to upload (failed weights are not counted) """
+        return sum(1 for record in self.records.values() if not record['failed'])
+
+    def enqueue(self, weights):
+        """
+        Queues weights for upload, weights that are already queued are skipped
+        @type weights: list(dict)
+        @param weights: weight data as stored by the WeightLogger
+        @return (int) number of newly queued weights
+        """
+        queued = 0
+        for weight_data in sorted(weights, key=lambda w: w['timestamp']):
+            key = generate_idempotency_key(weight_data)
+            if key in self.records:
+                continue
+            self.records[key] = {
+                'key': key,
+                'user_id': weight_data['user_id'],
+                'weight': weight_data['weight'],
+                'timestamp': weight_data['timestamp'],
+                'utc_offset': weight_data['utc_offset'],
+                'attempts': 0,
+                'last_error': None,
+                'next_attempt': 0,
+                'failed': False,
+            }
+            queued += 1
+        if queued:
+            logging.info('[WSO] Queued {} weights for upload'.format(queued))
+            self._store()
+        return queued
+
+    def get_pending_by_user(self):
+        """
+        Returns a dict of user_id -> list of weight data to upload, in the order they were logged. Users whose first
+        weight is waiting to be retried are left out, so the weights of a user are still uploaded in order.
+        """
+        pending_by_user = defaultdict(list)
+        for record in self.records.values():
+            if record['failed']:
+                continue
+            pending_by_user[record['user_id']].append({
+                'key': record['key'],
+                'user_id': record['user_id'],
+                'weight': record['weight'],
+                'timestamp': record['timestamp'],
+                'utc_offset': record['utc_offset'],
+                'synced': False,
+            })
+        current_time = time.time()
+        for user_id, pending in list(pending_by_user.items()):
+            pending.sort(key=lambda w: w['timestamp'])
+            if self.records[pending[0]['key']]['next_attempt'] > current_time:
+                del pending_by_user[user_id]
+        return pending_by_user
+
+    def get_failed(self):
+        """ Returns the records of the weights that are no longer retried """
+        return [record for record in self.records.values() if record['failed']]
+
+    def complete(self, weights, failures=None):
+        """
+        Removes uploaded weights from the outbox and records failed attempts
+        @type weights: list(dict)
+        @param weights: uploaded weights
+        @type failures: list((dict, str, bool))
+        @param failures: (optional) weights that failed to upload along with the error and whether the failure is
+                         permanent (the weight is not retried)
+        """
+        for weight_data in weights:
+            self.records.pop(weight_data['key'], None)
+        for weight_data, error, permanent in failures or []:
+            record = self.records.get(weight_data['key'])
+            if not record:
+                continue
+            record['attempts'] += 1
+            record['last_error'] = error
+            if permanent or record['attempts'] >= FITBIT_SYNC_MAX_ATTEMPTS:
+                record['failed'] = True
+                logging.error('[WSO] Giving up uploading weight {:.2f} of user {} after {} attempts. {}'.format(
+                    record['weight'], record['user_id'], record['attempts'], error)
+                )
+                continue
+            retry_delay = min(FITBIT_SYNC_RETRY_DELAY_SECS * 2 ** (record['attempts'] - 1),
+                              FITBIT_SYNC_MAX_RETRY_DELAY_SECS)
+            record['next_attempt'] = int(time.time()) + retry_delay
+        if weights or failures:
+            self._store()
@@ -5,18 +5,35 @@ import hmac
 import json
 import os
 import os.path as os_path
+from collections import defaultdict
 from inspect import getsourcefile
 from datetime import datetime, timedelta
+from threading import Lock, RLock
 
 from config import DATETIME_FORMAT
 
-user_data_file_location = '/fitbit_sync/auth_data/'
+base_file = os.path.abspath(getsourcefile(lambda: 0))
+user_data_file_location = os_path.join(os_path.dirname(base_file), 'auth_data')
+
+# Basic data of existing users and the modification time of the user data directory it was read at
+existing_users_cache = {'modified': None, 'users': []}
+
+# User files are read and written by the web server, the synchronisation thread and the token refresh callbacks
+user_locks = defaultdict(RLock)
+user_locks_lock = Lock()
+user_creation_lock = Lock()
+
+USER_DATA_FIELDS = ('user_name', 'token_data', 'csrf_token')
+
+
+def get_user_lock(user_id):
+    """ Returns the lock guarding the data file of the user """
+    with user_locks_lock:
+        return user_locks[user_id]
 
 
 def get_user_file_location(user_id):
-    base_file = os.path.abspath(getsourcefile(lambda: 0))
-    base_file_location = base_file[:len(base_file) - 7]
-    return os_path.join(base_file_location, user_data_file_location, 'user_{}.json'.format(user_id))
+    return os_path.join(user_data_file_location, 'user_{}.json'.format(user_id))
 
 # General class to read/write user data from json file
 
@@ -33,6 +50,10 @@ class FitBitUser:
         self.user_id = user_id
         self.user_exists = False
         self.auth_data_file_location = get_user_file_location(user_id)
+        self.lock = get_user_lock(user_id)
+        self._load()
+
+    def _load(self):
         self.user_data = self._get_user_data_data_from_file()
         self.user_name = self._get_user_name()
         self.user_token = self._get_user_token()
@@ -40,15 +61,20 @@ class FitBitUser:
 
     def _get_user_data_data_from_file(self):
         """ Reads user data from json file """
-        if not os_path.isfile(self.auth_data_file_location):
-            return {}
-        user_auth_file = open(self.auth_data_file_location, 'r')
-        user_data = json.loads(user_auth_file.read())
-        user_auth_file.close()
+        with self.lock:
+            if not os_path.isfile(self.auth_data_file_location):
+                return {}
+            with open(self.auth_data_file_location, 'r') as user_auth_file:
+                user_data = json.loads(user_auth_file.read())
         if user_data:
             self.user_exists = True
         return user_data
 
+    def _get_changed_fields(self):
+        """ Returns the fields changed in memory since the user data was loaded """
+        current = dict(zip(USER_DATA_FIELDS, (self.user_name, self.user_token, self.csrf_token)))
+        return dict((field, value) for field, value in current.items() if value != self.user_data.get(field))
+
     def _get_user_name(self):
         """ Gets username from loaded data """
         return self.user_data.get('user_name')
@@ -82,14 +108,26 @@ class FitBitUser:
         return hmac.compare_digest(current_csrf, provided_csrf)
 
     def store_user_data(self):
-        """ Stores user data from memory to file """
-        with open(self.auth_data_file_location, 'w') as user_data_file:
-            user_data_file.write(json.dumps({
-                'user_id': self.user_id,
-                'user_name': self.user_name,
-                'token_data': self.user_token,
-                'csrf_token': self.csrf_token
-            }))
+        """
+        Stores user data from memory to file. Only the fields changed by this instance are written over the data
+        currently in the file, so instances loaded at the same time (e.g. the web server storing a CSRF token while the
+        synchronisation thread refreshes the token) don't overwrite each other's changes.
+        """
+        with self.lock:
+            changed_fields = self._get_changed_fields()
+            user_data = self._get_user_data_data_from_file()
+            user_data.update(changed_fields)
+            user_data['user_id'] = self.user_id
+            for field in USER_DATA_FIELDS:
+                user_data.setdefault(field, None)
+            # Write to a temporary file first so readers never see a partially written file
+            temporary_file = '{}.tmp'.format(self.auth_data_file_location)
+            with open(temporary_file, 'w') as user_data_file:
+                user_data_file.write(json.dumps(user_data))
+            os.rename(temporary_file, self.auth_data_file_location)
+            self.user_exists = True
+            self.user_data = user_data
+            self.user_name, self.user_token, self.csrf_token = (user_data[field] for field in USER_DATA_FIELDS)
 
     def generate_new_user_csrf_token(self):
         """ Generates a new csrf token for the user and stores it """
@@ -110,13 +148,14 @@ def create_new_fitbit_user(user_name):
     @return (int) created user id
     """
     empty_user_id = None
-    for user_id in range(1, 1000):
-        if not os_path.isfile(get_user_file_location(user_id)):
-            empty_user_id = user_id
-            user = FitBitUser(user_id)
-            user.user_name = user_name
-            user.store_user_data()
-            break
+    with user_creation_lock:  # Two users created at the same time must not get the same id
+        for user_id in range(1, 1000):
+            if not os_path.isfile(get_user_file_location(user_id)):
+                empty_user_id = user_id
+                user = FitBitUser(user_id)
+                user.user_name = user_name
+                user.store_user_data()
+                break
     return empty_user_id
 
 
@@ -125,6 +164,11 @@ def get_all_existing_fitbit_users():
     Gets all existing users
     @return (list(dict)) a list of all basic user data - user_id and user_name
     """
+    # User files are only ever added, so the list only needs to be read again when the directory changes
+    modified = os_path.getmtime(user_data_file_location)
+    if existing_users_cache['modified'] == modified:
+        return list(existing_users_cache['users'])
+
     existing_users = list()
     for user_id in range(1, 1000):
         if os_path.isfile(get_user_file_location(user_id)):
@@ -132,7 +176,8 @@ def get_all_existing_fitbit_users():
             if not user.user_exists:
                 continue
             existing_users.append({'user_id': user_id, 'user_name': user.user_name})
-    return existing_users
+    existing_users_cache.update(modified=modified, users=existing_users)
+    return list(existing_users)
 
 
 def get_user_id_by_csrf(csrf):
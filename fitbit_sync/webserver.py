@@ -1,17 +1,51 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
+import os.path
+from datetime import datetime
 
-from flask import Flask, redirect, render_template, request
+from flask import Flask, jsonify, make_response, redirect, render_template, request
 from flask_bootstrap import Bootstrap
+from werkzeug.serving import make_ssl_devcert, run_simple
 
-from config import FITBIT_SYNC_ENABLED
+try:
+    from cheroot import wsgi
+    from cheroot.ssl.builtin import BuiltinSSLAdapter
+except ImportError:
+    wsgi = None
 
-from fitbit_oauth_user_client import FitBitOAuth2UserClient
-from fitbit_sync.user import create_new_fitbit_user, get_all_existing_fitbit_users, get_user_id_by_csrf
+from config import DATETIME_FORMAT, FITBIT_SYNC_ENABLED, FITBIT_AUTH_SERVER_PORT, FITBIT_AUTH_SERVER_THREADS
+
+from fitbit_sync.fitbit_oauth_user_client import FitBitOAuth2UserClient
+from fitbit_sync.user import (
+    create_new_fitbit_user, get_all_existing_fitbit_users, get_user_id_by_csrf, user_data_file_location
+)
+from weight_logger.weight_logger import get_weight_logger
+
+CERTIFICATE_BASE_PATH = os.path.join(user_data_file_location, 'server')
 
 app = Flask(__name__)
+app.config['BOOTSTRAP_SERVE_LOCAL'] = True  # Serve Bootstrap assets from the device instead of a CDN
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 7 * 24 * 60 * 60
 Bootstrap(app)
 
+# Last rendered page of every template along with the context it was rendered with and its ETag
+rendered_page_cache = {}
+
+
+def render_cached_page(template, **context):
+    """ Renders a template only when its context changes and responds with an ETag so browsers can reuse it """
+    context_key = repr(sorted(context.items()))
+    cached = rendered_page_cache.get(template)
+    if not cached or cached[0] != context_key:
+        page = render_template(template, **context)
+        cached = (context_key, page, hashlib.sha1(page.encode('utf8')).hexdigest())
+        rendered_page_cache[template] = cached
+    _, page, etag = cached
+    response = make_response(page)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 
 @app.route('/')
 def no_route():
@@ -20,13 +54,13 @@ def no_route():
 
 @app.route('/fitbit_auth')
 def fitbit_auth():
-    return render_template('fitbit_auth.html', user_data=get_all_existing_fitbit_users())
+    return render_cached_page('fitbit_auth.html', user_data=get_all_existing_fitbit_users())
 
 
 # User routes
 @app.route('/create_new_user')
 def create_new_user():
-    return render_template('new_user.html')
+    return render_cached_page('new_user.html')
 
 
 @app.route('/fitbit_create_user', methods=['POST'])
@@ -66,13 +100,83 @@ def auth_token_handle():
 
 @app.route('/successfully_authorised')
 def successfully_authorised():
-    return render_template('successfully_authorised.html')
+    return render_cached_page('successfully_authorised.html')
+
+
+# Weight analytics API routes
+def _format_dates(data):
+    """ Recursively formats datetime objects in the analytics data using the configured date format """
+    if isinstance(data, dict):
+        return {key: _format_dates(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_format_dates(value) for value in data]
+    if isinstance(data, datetime):
+        return data.strftime(DATETIME_FORMAT)
+    return data
+
+
+def _get_analytics_params():
+    """ Reads the moving average window and the (optional) start date from the request query string """
+    window = request.args.get('window', 7, type=int)
+    since = request.args.get('since')
+    if since:
+        since = datetime.strptime(since, '%Y-%m-%d')
+    return window, since
+
+
+def get_weight_history():
+    """ Returns the columnar history of all weights, brought up to date with the weight log """
+    wl = get_weight_logger()
+    wl.refresh()
+    return wl.get_full_history()
+
+
+@app.route('/api/weights')
+def weights_summary():
+    try:
+        window, since = _get_analytics_params()
+    except ValueError:
+        return jsonify({'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+    history = get_weight_history()
+    summaries = [history.user_summary(user_id, window, since) for user_id in history.user_ids().tolist()]
+    return jsonify({'users': _format_dates(summaries)})
+
+
+@app.route('/api/weights/<int:user_id>')
+def user_weights_summary(user_id):
+    try:
+        window, since = _get_analytics_params()
+    except ValueError:
+        return jsonify({'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+    history = get_weight_history()
+    return jsonify(_format_dates(history.user_summary(user_id, window, since)))
+
+
+def get_ssl_certificate():
+    """ Returns the (certificate, key) file paths of the self-signed certificate, generating it only once """
+    certificate, key = '{}.crt'.format(CERTIFICATE_BASE_PATH), '{}.key'.format(CERTIFICATE_BASE_PATH)
+    if not os.path.isfile(certificate) or not os.path.isfile(key):
+        logging.info("[FBAS] Generating a self-signed certificate")
+        certificate, key = make_ssl_devcert(CERTIFICATE_BASE_PATH, host='localhost')
+    return certificate, key
 
 
 def main():
     logging.info("Starting FitBit Authentication web server (FBAS)")
-    if FITBIT_SYNC_ENABLED:  # No point in running this server if FitBit sync is not enabled
-        app.run(port=443, host="0.0.0.0", ssl_context='adhoc')
+    if not FITBIT_SYNC_ENABLED:  # No point in running this server if FitBit sync is not enabled
+        return
+    certificate, key = get_ssl_certificate()
+    if wsgi:
+        logging.info("[FBAS] Serving with cheroot using {} threads".format(FITBIT_AUTH_SERVER_THREADS))
+        server = wsgi.Server(('0.0.0.0', FITBIT_AUTH_SERVER_PORT), app, numthreads=FITBIT_AUTH_SERVER_THREADS)
+        server.ssl_adapter = BuiltinSSLAdapter(certificate, key)
+        try:
+            server.start()
+        finally:
+            server.stop()
+    else:
+        logging.info("[FBAS] cheroot is not installed, serving with the threaded werkzeug server")
+        run_simple('0.0.0.0', FITBIT_AUTH_SERVER_PORT, app, threaded=True, ssl_context=(certificate, key))
 
 
 if __name__ == "__main__":
@@ -1,13 +1,116 @@
 # -*- coding: utf-8 -*-
 import logging
 import time
-from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from six import iteritems
 
-from config import FITBIT_SYNC_ENABLED, WEIGHT_SYNC_LOOP_TIME_SECS
-from fitbit_oauth_user_client import FitBitOAuth2UserClient
-from weight_logger.weight_logger import WeightLogger
+from config import (
+    FITBIT_HTTP_CONNECT_TIMEOUT_SECS, FITBIT_SYNC_ENABLED, FITBIT_RECONCILE_WEIGHTS, FITBIT_SYNC_THREADS,
+    WEIGHT_SYNC_LOOP_TIME_SECS
+)
+from fitbit_sync.fitbit_oauth_user_client import FitBitOAuth2UserClient
+from fitbit_sync.outbox import SyncOutbox, is_reachable
+from weight_logger.timestamps import to_local_datetime
+from weight_logger.weight_logger import get_weight_logger
+
+
+def sync_user_weights(client, weight_data):
+    """
+    Logs the pending weights of a single user on FitBit in order, stopping at the first failure so that the order is
+    kept when the remaining weights are retried
+    @type client: FitBitOAuth2UserClient
+    @param client: client of the user
+    @type weight_data: list(dict)
+    @param weight_data: pending weights of the user
+    @return (list(dict), list((dict, str, bool))) weights that are logged on FitBit and the failed weight with its error
+            and whether the failure is permanent
+    """
+    weights_logged = list()
+    if FITBIT_RECONCILE_WEIGHTS:
+        # Skip weights that are already logged on FitBit and mark them as synced
+        already_logged = client.reconcile_weights(weight_data)
+        weights_logged.extend(already_logged)
+        logged_ids = set(id(logged) for logged in already_logged)
+        weight_data = [w for w in weight_data if id(w) not in logged_ids]
+
+    for single_weight_data in weight_data:
+        # Attempt to log each weight
+        logged = client.log_user_weight(
+            weight=single_weight_data['weight'],
+            date=to_local_datetime(single_weight_data['timestamp'], single_weight_data['utc_offset'])
+        )
+        if not logged:
+            logging.error(
+                "[WST] Failed to log user {} weight on FitBit. Please check user authentication!".format(
+                    client.user_id
+                )
+            )
+            return weights_logged, [(single_weight_data, client.last_error, client.last_error_permanent)]
+
+        weights_logged.append(single_weight_data)
+    return weights_logged, []
+
+
+def get_pending_syncs(outbox, clients, create_client=FitBitOAuth2UserClient):
+    """
+    Returns the weights due for upload of every user linked to FitBit. Weights of users that aren't linked wait in the
+    outbox without counting as failed attempts.
+    @type outbox: SyncOutbox
+    @param outbox: outbox with the weights to upload
+    @type clients: dict
+    @param clients: user_id -> client, clients are kept between calls so their connections are kept alive
+    @type create_client: callable
+    @param create_client: (optional) creates the client of a user id
+    @return (list((FitBitOAuth2UserClient, list(dict)))) client and pending weights of every user to synchronise
+    """
+    pending_syncs = list()
+    for user_id, weight_data in iteritems(outbox.get_pending_by_user()):
+        client = clients.get(user_id) or create_client(user_id)  # Get user client
+        if not client.is_authorised() or not client.is_linked():  # Check if user is authenticated
+            # Not kept, so the user data is read again on the next loop in case the user has been linked
+            clients.pop(user_id, None)
+            continue
+        clients[user_id] = client
+        pending_syncs.append((client, weight_data))
+    return pending_syncs
+
+
+def sync_pending_weights(wl, outbox, pool, clients, pending_syncs):
+    """
+    Uploads the pending weights, the users are synchronised in parallel
+    @type wl: WeightLogger
+    @param wl: weight logger to update the sync status in
+    @type outbox: SyncOutbox
+    @param outbox: outbox with the weights to upload
+    @type pool: ThreadPool
+    @param pool: pool running the synchronisation of every user
+    @type clients: dict
+    @param clients: user_id -> client, the client of a user is dropped when an upload fails
+    @type pending_syncs: list((FitBitOAuth2UserClient, list(dict)))
+    @param pending_syncs: client and pending weights of every user, see get_pending_syncs
+    """
+    user_syncs = list()
+    for client, weight_data in pending_syncs:
+        # Attempt weight logging for each user
+        user_syncs.append((client.user_id, pool.apply_async(sync_user_weights, (client, weight_data))))
+
+    weights_logged, failures = list(), list()
+    for user_id, user_sync in user_syncs:
+        try:
+            user_weights_logged, user_failures = user_sync.get()
+        except Exception as exc:
+            logging.error("[WST] Synchronisation of user {} failed. {}:{}".format(user_id, type(exc).__name__, exc))
+            user_weights_logged, user_failures = list(), list()
+        if user_failures:
+            # The user might have been authorised again in the mean time, load the user data on the next loop
+            clients.pop(user_id, None)
+        weights_logged.extend(user_weights_logged)
+        failures.extend(user_failures)
+
+    if weights_logged:
+        wl.update_weight_sync_status(weights_logged)
+    outbox.complete(weights_logged, failures)
 
 
 def main():
@@ -16,45 +119,34 @@ def main():
     if not FITBIT_SYNC_ENABLED:
         return
 
+    wl = get_weight_logger()
+    outbox = SyncOutbox()
+    pool = ThreadPool(FITBIT_SYNC_THREADS)
+    clients = {}  # Clients are reused between loops so their connections are kept alive
+    online = True
     while True:
-        # Get unsynced weight data
-        wl = WeightLogger()
-        unsynced_weight_data = wl.get_unsynced_weight_data()
-        if not unsynced_weight_data:
+        # Pick up weights logged since the last loop and queue the unsynced ones for upload
+        wl.refresh()
+        outbox.enqueue(wl.get_unsynced_weight_data())
+        pending_syncs = get_pending_syncs(outbox, clients)
+        if not pending_syncs:
             time.sleep(WEIGHT_SYNC_LOOP_TIME_SECS)
             continue
 
-        # Group weight data by user
-        weight_data_by_user = defaultdict(lambda: list())
-        for weight_data in unsynced_weight_data:
-            uid = weight_data.get('user_id')
-            weight_data_by_user[uid].append(weight_data)
-
-        weights_logged = list()
-        for user_id, weight_data in iteritems(weight_data_by_user):
-            # Attempt weight logging for each user
-            client = FitBitOAuth2UserClient(user_id)  # Get user client
-            if not client.is_authorised():  # Check if user is authenticated
-                continue
-
-            for single_weight_data in weight_data:
-                # Attempt to log each weight
-                logged = client.log_user_weight(
-                    weight=single_weight_data['weight'],
-                    date=single_weight_data['date_logged']
+        # Pause while FitBit can't be reached instead of firing requests that are bound to fail
+        if not is_reachable(FitBitOAuth2UserClient.API_ENDPOINT, FITBIT_HTTP_CONNECT_TIMEOUT_SECS):
+            if online:
+                logging.info("[WST] FitBit is unreachable, pausing synchronisation of {} weights".format(
+                    sum(len(weight_data) for _, weight_data in pending_syncs))
                 )
-                if not logged:
-                    logging.error(
-                        "[WST] Failed to log user {} weight on FitBit. Please check user authentication!".format(
-                            user_id
-                        )
-                    )
-                    continue
-
-                weights_logged.append(single_weight_data)
-
-        if weights_logged:
-            wl.update_weight_sync_status(weights_logged)
+            online = False
+            time.sleep(WEIGHT_SYNC_LOOP_TIME_SECS)
+            continue
+        if not online:
+            logging.info("[WST] FitBit is reachable again, resuming synchronisation")
+            online = True
+
+        sync_pending_weights(wl, outbox, pool, clients, pending_syncs)
         time.sleep(WEIGHT_SYNC_LOOP_TIME_SECS)
 
 
@@ -5,9 +5,7 @@ import time
 from inspect import getsourcefile
 from threading import Thread
 
-from config import FITBIT_SYNC_ENABLED, LOG_LOCATION, DATETIME_FORMAT
-from fitbit_sync import webserver, weight_sync
-from wii_fit_bt_weight_tracker import tracker
+from config import FITBIT_SYNC_ENABLED, LOG_LOCATION, DATETIME_FORMAT, TRACKER_PROCESS_ISOLATION
 
 
 def main():
@@ -15,16 +13,30 @@ def main():
     base_file = os.path.abspath(getsourcefile(lambda: 0))
     base_file_location = base_file[:len(base_file)-7]
     log_location = os.path.join(base_file_location, LOG_LOCATION)
-    logging.basicConfig(filename=log_location, filemode='a', format='%(asctime)s %(message)s', datefmt=DATETIME_FORMAT,
-                        level=logging.INFO)
+    logging_config = dict(filename=log_location, filemode='a', format='%(asctime)s %(message)s',
+                          datefmt=DATETIME_FORMAT, level=logging.INFO)
+    logging.basicConfig(**logging_config)
 
+    tracker_supervisor = None
     try:
-        # Start Bluetooth tracking thread
-        bt_thread = Thread(name="[WiiFitBoardBit] BT Tracking", target=tracker.main)
-        bt_thread.setDaemon(True)
-        bt_thread.start()
+        # Subsystems are imported only once they are needed so that tracking starts as soon as possible after boot
+        if TRACKER_PROCESS_ISOLATION:
+            from wii_fit_bt_weight_tracker.process import TrackerSupervisor
+
+            # Start Bluetooth tracking process, before any other threads are started
+            tracker_supervisor = TrackerSupervisor(logging_config)
+            tracker_supervisor.start()
+        else:
+            from wii_fit_bt_weight_tracker import tracker
+
+            # Start Bluetooth tracking thread
+            bt_thread = Thread(name="[WiiFitBoardBit] BT Tracking", target=tracker.main)
+            bt_thread.setDaemon(True)
+            bt_thread.start()
 
         if FITBIT_SYNC_ENABLED:
+            from fitbit_sync import webserver, weight_sync
+
             # Start FitBit authentication Flask webserver thread
             flask_thread = Thread(name="[WiiFitBoardBit] FitBit Authentication Web Server", target=webserver.main)
             flask_thread.setDaemon(True)
@@ -39,8 +51,12 @@ def main():
                          "threads were not started")
         while True:
             time.sleep(5)
+            if tracker_supervisor:
+                tracker_supervisor.check()
     except KeyboardInterrupt:
         logging.info("Stopping due to Keyboard Interrupt event")
+        if tracker_supervisor:
+            tracker_supervisor.stop()
         logging.shutdown()
         print("Exiting")
         exit(0)
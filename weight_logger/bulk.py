@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk import and export of the weight log.
+
+Usage:
+    python -m weight_logger.bulk import <path> [--format csv|jsonl|fitbit]
+    python -m weight_logger.bulk export <path> [--format csv|jsonl]
+
+Imports are streamed in chunks, entries already present in the weight log (same time and weight) are skipped, users are
+assigned with the same weight matching logic used for new weigh-ins and the weight log is written once at the end.
+Dates and times without a UTC offset are taken as the local time of this device.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import logging
+import os.path
+from datetime import datetime
+from itertools import islice
+
+from six import iteritems
+
+from config import DATETIME_FORMAT
+from weight_logger.segments import format_weight, get_csv_file_options
+from weight_logger.timestamps import format_local, from_local_datetime, get_utc_offset
+from weight_logger.weight_logger import WeightLogger, assign_user_id_by_weight
+
+CHUNK_SIZE = 5000
+FITBIT_EXPORT_DATETIME_FORMAT = '%m/%d/%y %H:%M:%S'
+IMPORT_FORMATS = ('csv', 'jsonl', 'fitbit')
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
+def _chunks(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_record(record):
+    """
+    Converts a raw record (dict read from CSV or JSON) to weight data. Records must contain the weight and either a
+    `timestamp` (seconds since epoch, UTC), a `datetime` or a `date` and `time` value. `utc_offset` (seconds), `user_id`
+    and `synced` are optional.
+    """
+    utc_offset = record.get('utc_offset')
+    utc_offset = int(utc_offset) if utc_offset not in (None, '') else None
+    if record.get('timestamp') not in (None, ''):
+        timestamp = int(record['timestamp'])
+        if utc_offset is None:
+            utc_offset = get_utc_offset(timestamp)
+    else:
+        if 'datetime' in record:
+            date_logged = datetime.strptime(record['datetime'], DATETIME_FORMAT)
+        else:
+            date_logged = datetime.strptime('{} {}'.format(record['date'], record['time']), DATETIME_FORMAT)
+        timestamp, utc_offset = from_local_datetime(date_logged, utc_offset)
+    user_id = record.get('user_id')
+    synced = record.get('synced', False)
+    return {
+        'user_id': int(user_id) if user_id not in (None, '') else None,
+        'weight': round(float(record['weight']), 2),
+        'timestamp': timestamp,
+        'utc_offset': utc_offset,
+        'synced': synced in (True, 'True', '1'),
+    }
+
+
+def _read_csv(path):
+    with open(path) as import_file:
+        for record in csv.DictReader(import_file, **get_csv_file_options()):
+            yield _parse_record(record)
+
+
+def _read_jsonl(path):
+    with open(path) as import_file:
+        for line in import_file:
+            line = line.strip()
+            if line:
+                yield _parse_record(json.loads(line))
+
+
+def _read_fitbit(path):
+    """
+    Reads the weight files of a FitBit account data export (`weight-YYYY-MM-DD.json`). The path can be a single file or
+    the directory containing them. Exported weights already exist on FitBit so they are imported as synced.
+    """
+    paths = sorted(glob.glob(os.path.join(path, 'weight-*.json'))) if os.path.isdir(path) else [path]
+    for export_path in paths:
+        with open(export_path) as export_file:
+            for entry in json.load(export_file):
+                timestamp, utc_offset = from_local_datetime(datetime.strptime(
+                    '{} {}'.format(entry['date'], entry['time']), FITBIT_EXPORT_DATETIME_FORMAT
+                ))
+                yield {
+                    'user_id': None,
+                    'weight': round(float(entry['weight']), 2),
+                    'timestamp': timestamp,
+                    'utc_offset': utc_offset,
+                    'synced': True,
+                }
+
+
+READERS = {
+    'csv': _read_csv,
+    'jsonl': _read_jsonl,
+    'fitbit': _read_fitbit,
+}
+
+
+def _weight_key(weight_data):
+    return weight_data['timestamp'], format_weight(weight_data['weight'])
+
+
+def _guess_format(path):
+    if os.path.isdir(path) or os.path.basename(path).startswith('weight-'):
+        return 'fitbit'
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        return 'jsonl'
+    return 'csv'
+
+
+def import_weights(path, file_format=None, weight_logger=None):
+    """
+    Imports weights from a file into the weight log
+    @type path: str
+    @param path: file (or FitBit export directory) to import
+    @type file_format: str
+    @param file_format: (optional) one of IMPORT_FORMATS, guessed from the path when not provided
+    @type weight_logger: WeightLogger
+    @param weight_logger: (optional) weight logger to import into
+    @return (int, int) number of imported and skipped (duplicate) entries
+    """
+    file_format = file_format or _guess_format(path)
+    wl = weight_logger or WeightLogger()
+    logging.info("[WLB] Importing {} weights from {}".format(file_format, path))
+
+    known_keys = set(_weight_key(weight) for weight in wl.get_all_weights())
+    latest_weights = wl.get_latest_weights_by_user()
+    latest_timestamp_by_user = {user_id: w['timestamp'] for user_id, w in iteritems(latest_weights)}
+    latest_weight_by_user = {user_id: w['weight'] for user_id, w in iteritems(latest_weights)}
+
+    new_weights = list()
+    skipped = 0
+    for chunk in _chunks(READERS[file_format](path)):
+        chunk.sort(key=lambda w: w['timestamp'])
+        for weight_data in chunk:
+            key = _weight_key(weight_data)
+            if key in known_keys:
+                skipped += 1
+                continue
+            known_keys.add(key)
+            user_id = weight_data['user_id']
+            if user_id is None:
+                user_id = assign_user_id_by_weight(weight_data['weight'], latest_weight_by_user)
+                weight_data['user_id'] = user_id
+            if user_id not in latest_timestamp_by_user or latest_timestamp_by_user[user_id] <= weight_data['timestamp']:
+                latest_timestamp_by_user[user_id] = weight_data['timestamp']
+                latest_weight_by_user[user_id] = weight_data['weight']
+            new_weights.append(weight_data)
+
+    wl.add_weights(new_weights)
+    logging.info("[WLB] Imported {} weights, skipped {} duplicates".format(len(new_weights), skipped))
+    return len(new_weights), skipped
+
+
+def export_weights(path, file_format='csv', weight_logger=None):
+    """
+    Exports all weights in the weight log to a file
+    @type path: str
+    @param path: file to export to
+    @type file_format: str
+    @param file_format: one of EXPORT_FORMATS
+    @type weight_logger: WeightLogger
+    @param weight_logger: (optional) weight logger to export from
+    @return (int) number of exported entries
+    """
+    wl = weight_logger or WeightLogger()
+    weights = wl.get_all_weights()
+    logging.info("[WLB] Exporting {} weights to {}".format(len(weights), path))
+    with open(path, 'w') as export_file:
+        if file_format == 'jsonl':
+            for weight_data in weights:
+                export_file.write(json.dumps({
+                    'user_id': weight_data['user_id'],
+                    'weight': weight_data['weight'],
+                    'timestamp': weight_data['timestamp'],
+                    'utc_offset': weight_data['utc_offset'],
+                    'datetime': format_local(weight_data['timestamp'], weight_data['utc_offset'], DATETIME_FORMAT),
+                    'synced': weight_data['synced'],
+                }) + '\n')
+        else:
+            csv_writer = csv.writer(export_file, **get_csv_file_options())
+            csv_writer.writerow(wl.log_header_columns)
+            csv_writer.writerows(wl._format_weight_data_as_file_row(weight_data) for weight_data in weights)
+    return len(weights)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import or export the WiiFitBoardBit weight log')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('path', help='File to import from/export to (or a FitBit export directory to import)')
+    parser.add_argument('--format', dest='file_format', choices=IMPORT_FORMATS, help='File format')
+    args = parser.parse_args()
+
+    if args.action == 'import':
+        imported, skipped = import_weights(args.path, args.file_format)
+        print("Imported {} weights ({} duplicates skipped)".format(imported, skipped))
+    else:
+        if args.file_format and args.file_format not in EXPORT_FORMATS:
+            parser.error('Export format must be one of: {}'.format(', '.join(EXPORT_FORMATS)))
+        exported = export_weights(args.path, args.file_format or _guess_format(args.path))
+        print("Exported {} weights".format(exported))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Locks shared by the tracking, logging, web server and synchronisation threads.
+
+ReadWriteLock lets any number of threads read shared state at once while writes are exclusive. A thread holding the
+write lock can take the read or write lock again (e.g. a write method calling a read method), a thread holding the read
+lock can take the read lock again but can never upgrade to the write lock.
+
+FileLock serialises file rewrites and appends between processes (e.g. the bulk import command and a running
+WiiFitBoardBit).
+"""
+
+import fcntl
+from functools import wraps
+from threading import Condition, Lock, local
+
+from six.moves import _thread
+
+
+class ReadWriteLock:
+
+    def __init__(self):
+        self._condition = Condition(Lock())
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._local = local()
+
+    def _read_depth(self):
+        return getattr(self._local, 'read_depth', 0)
+
+    def acquire_read(self):
+        thread_id = _thread.get_ident()
+        with self._condition:
+            if self._writer == thread_id:
+                self._write_depth += 1
+                return
+            if self._read_depth() == 0:
+                # New readers wait for waiting writers so that writers are never starved
+                while self._writer is not None or self._writers_waiting:
+                    self._condition.wait()
+                self._readers += 1
+            self._local.read_depth = self._read_depth() + 1
+
+    def release_read(self):
+        thread_id = _thread.get_ident()
+        with self._condition:
+            if self._writer == thread_id:
+                self._release_write_depth()
+                return
+            self._local.read_depth = self._read_depth() - 1
+            if self._local.read_depth == 0:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    def acquire_write(self):
+        thread_id = _thread.get_ident()
+        with self._condition:
+            if self._writer == thread_id:
+                self._write_depth += 1
+                return
+            if self._read_depth():
+                raise RuntimeError("Can't acquire the write lock while holding the read lock")
+            self._writers_waiting += 1
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = thread_id
+            self._write_depth = 1
+
+    def release_write(self):
+        with self._condition:
+            self._release_write_depth()
+
+    def _release_write_depth(self):
+        self._write_depth -= 1
+        if not self._write_depth:
+            self._writer = None
+            self._condition.notify_all()
+
+
+class FileLock:
+    """ Exclusive lock between processes, held on a separate lock file next to the protected file """
+
+    def __init__(self, path):
+        self.lock_file_path = '{}.lock'.format(path)
+        self._lock = Lock()  # flock is per open file, the thread lock keeps threads of this process from sharing it
+        self._lock_file = None
+        self._owner = None
+        self._depth = 0
+
+    def __enter__(self):
+        thread_id = _thread.get_ident()
+        if self._owner == thread_id:
+            self._depth += 1
+            return self
+        self._lock.acquire()
+        self._owner = thread_id
+        self._depth = 1
+        self._lock_file = open(self.lock_file_path, 'a')
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth:
+            return
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+        self._owner = None
+        self._lock.release()
+
+
+def reads(method):
+    """ Runs the method holding the read lock of the instance (`self._lock`) """
+    @wraps(method)
+    def locked_method(self, *args, **kwargs):
+        self._lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release_read()
+    return locked_method
+
+
+def writes(method):
+    """ Runs the method holding the write lock of the instance (`self._lock`) """
+    @wraps(method)
+    def locked_method(self, *args, **kwargs):
+        self._lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release_write()
+    return locked_method
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Time partitioned weight log.
+
+The weight log is split into one segment per month (UTC) of the weigh-in, e.g. data/weight/2024-03.csv. The manifest
+(data/weight/manifest.json) describes every segment - the number of weights, their time range, the number of weights
+not yet synchronised and the latest weight of every user - so segments don't have to be read to assign a weigh-in to a
+user or to find the weights to synchronise. Segments of past months are compacted into compressed files
+(2024-03.csv.gz) once all of their weights are synchronised.
+"""
+
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+
+from six import StringIO, iteritems
+
+from config import DATETIME_FORMAT
+from weight_logger.timestamps import from_local_datetime
+
+LOG_HEADER_COLUMNS = ['user_id', 'weight', 'timestamp', 'utc_offset', 'synced']
+MANIFEST_FILE_NAME = 'manifest.json'
+SEGMENT_NAME_FORMAT = '%Y-%m'
+
+
+def get_csv_file_options():
+    return {
+        'delimiter': ',',
+        'quotechar': '"',
+        'quoting': csv.QUOTE_MINIMAL
+    }
+
+
+def format_weight(weight):
+    return '{:.2f}'.format(weight)
+
+
+def get_segment_name(timestamp):
+    """ Returns the name of the segment (UTC month) a weight logged at the timestamp belongs to """
+    return time.strftime(SEGMENT_NAME_FORMAT, time.gmtime(timestamp))
+
+
+def parse_weight_row(weight_line):
+    """ Converts a weight log row to weight data, rows of weight logs of older versions are accepted as well """
+    if not weight_line:
+        return
+    if len(weight_line) == 5:
+        return {
+            'user_id': int(weight_line[0]),
+            'weight': round(float(weight_line[1]), 2),
+            'timestamp': int(weight_line[2]),
+            'utc_offset': int(weight_line[3]),
+            'synced': weight_line[4] == '1',
+        }
+    if len(weight_line) == 4:
+        # Legacy log line, the time is stored as a formatted local datetime
+        timestamp, utc_offset = from_local_datetime(datetime.strptime(weight_line[2], DATETIME_FORMAT))
+        return {
+            'user_id': int(weight_line[0]),
+            'weight': round(float(weight_line[1]), 2),
+            'timestamp': timestamp,
+            'utc_offset': utc_offset,
+            'synced': weight_line[3] == 'True',
+        }
+
+
+def format_weight_row(weight_data):
+    return [
+        weight_data['user_id'],
+        format_weight(weight_data['weight']),
+        weight_data['timestamp'],
+        weight_data['utc_offset'],
+        1 if weight_data.get('synced', False) else 0
+    ]
+
+
+def parse_weight_lines(data, skip_header):
+    """ Converts complete lines of a weight log (bytes) to weight data """
+    lines = data.decode('utf8').splitlines()
+    if skip_header:
+        lines = lines[1:]
+    weights = list()
+    for file_line in csv.reader(lines, **get_csv_file_options()):
+        weight_data = parse_weight_row(file_line)
+        if weight_data:
+            weights.append(weight_data)
+    return weights
+
+
+def format_weight_lines(weights, header=False):
+    """ Converts weight data to weight log lines (bytes) """
+    lines = StringIO()
+    csv_writer = csv.writer(lines, **get_csv_file_options())
+    if header:
+        csv_writer.writerow(LOG_HEADER_COLUMNS)
+    csv_writer.writerows(format_weight_row(weight_data) for weight_data in weights)
+    return lines.getvalue().encode('utf8')
+
+
+def describe_segment(weights, compressed):
+    """ Returns the manifest entry of a segment """
+    latest_by_user = dict()
+    for weight_data in weights:
+        user_id = str(weight_data['user_id'])  # JSON keys are strings
+        if user_id not in latest_by_user or latest_by_user[user_id][0] <= weight_data['timestamp']:
+            latest_by_user[user_id] = [weight_data['timestamp'], weight_data['weight']]
+    timestamps = [weight_data['timestamp'] for weight_data in weights]
+    return {
+        'count': len(weights),
+        'first_timestamp': min(timestamps) if timestamps else None,
+        'last_timestamp': max(timestamps) if timestamps else None,
+        'unsynced': sum(1 for weight_data in weights if not weight_data['synced']),
+        'latest_by_user': latest_by_user,
+        'compressed': compressed,
+    }
+
+
+class WeightLogSegment:
+    """ Weights of a single month, stored in a CSV file or once compacted in a compressed CSV file """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.csv_path = os.path.join(directory, '{}.csv'.format(name))
+        self.compressed_path = '{}.gz'.format(self.csv_path)
+        self.weights = None  # Only set while the segment is loaded
+        self._inode = None
+        self._offset = 0
+
+    @property
+    def loaded(self):
+        return self.weights is not None
+
+    def is_compressed(self):
+        return not os.path.isfile(self.csv_path) and os.path.isfile(self.compressed_path)
+
+    def read(self):
+        """ Reads all weights of the segment without loading it """
+        return self._read_file()[0]
+
+    def load(self):
+        self.weights, self._inode, self._offset = self._read_file()
+        return self.weights
+
+    def unload(self):
+        self.weights = None
+        self._inode, self._offset = None, 0
+
+    def _read_file(self, offset=0):
+        """ Returns (weights, inode, offset) read from the offset, a line still being written is left for later """
+        if self.is_compressed():
+            with gzip.open(self.compressed_path, 'rb') as segment_file:
+                data = segment_file.read()
+            return parse_weight_lines(data, skip_header=True), os.stat(self.compressed_path).st_ino, None
+        if not os.path.isfile(self.csv_path):
+            return [], None, 0
+        with open(self.csv_path, 'rb') as segment_file:
+            inode = os.fstat(segment_file.fileno()).st_ino
+            segment_file.seek(offset)
+            data = segment_file.read()
+        data = data[:data.rfind(b'\n') + 1]
+        return parse_weight_lines(data, skip_header=offset == 0), inode, offset + len(data)
+
+    def read_appended(self):
+        """
+        Reads the weights appended to the loaded segment since it was last read
+        @return (list(dict)) the appended weights or None if the segment was rewritten and has to be loaded again
+        """
+        compressed = self.is_compressed()
+        try:
+            file_stat = os.stat(self.compressed_path if compressed else self.csv_path)
+        except OSError:
+            return None if self._inode is not None else []
+        if file_stat.st_ino != self._inode or (not compressed and file_stat.st_size < self._offset):
+            return None
+        if compressed or file_stat.st_size == self._offset:
+            return []
+        weights, _, self._offset = self._read_file(self._offset)
+        self.weights.extend(weights)
+        return weights
+
+    def append(self, weight_data):
+        """ Appends a weight to the CSV file of the (loaded and not compressed) segment """
+        new_file = not os.path.isfile(self.csv_path)
+        with open(self.csv_path, 'ab') as segment_file:
+            segment_file.write(format_weight_lines([weight_data], header=new_file))
+            if new_file:
+                self._inode = os.fstat(segment_file.fileno()).st_ino
+            self._offset = segment_file.tell()
+        self.weights.append(weight_data)
+
+    def store(self, compressed):
+        """ Writes all weights of the (loaded) segment, replacing the file in the other format """
+        path, other_path = self.csv_path, self.compressed_path
+        if compressed:
+            path, other_path = other_path, path
+        # Write to a temporary file first and replace the segment with it so an interrupted write never leaves a
+        # truncated segment behind
+        temporary_file = '{}.tmp'.format(path)
+        data = format_weight_lines(self.weights, header=True)
+        with open(temporary_file, 'wb') as segment_file:
+            if compressed:
+                with gzip.GzipFile(filename='', fileobj=segment_file, mode='wb') as compressed_file:
+                    compressed_file.write(data)
+            else:
+                segment_file.write(data)
+            segment_file.flush()
+            file_stat = os.fstat(segment_file.fileno())
+        os.rename(temporary_file, path)
+        if os.path.isfile(other_path):
+            os.remove(other_path)
+        self._inode, self._offset = file_stat.st_ino, (None if compressed else file_stat.st_size)
+
+
+class SegmentManifest:
+    """ Descriptions of all segments by segment name, stored as JSON next to the segments """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_FILE_NAME)
+        self.segments = dict()
+        self._file_state = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def reload(self):
+        """ Reads the manifest again if it was changed, returns True if it was """
+        try:
+            file_stat = os.stat(self.path)
+        except OSError:
+            return False
+        file_state = (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+        if file_state == self._file_state:
+            return False
+        with open(self.path) as manifest_file:
+            self.segments = json.load(manifest_file)['segments']
+        self._file_state = file_state
+        return True
+
+    def store(self):
+        temporary_file = '{}.tmp'.format(self.path)
+        with open(temporary_file, 'w') as manifest_file:
+            json.dump({'segments': self.segments}, manifest_file, sort_keys=True)
+        os.rename(temporary_file, self.path)
+        file_stat = os.stat(self.path)
+        self._file_state = (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+
+    def update(self, name, weights, compressed):
+        self.segments[name] = describe_segment(weights, compressed)
+
+    def get_latest_weights_by_user(self, names):
+        """ Returns a dict of user_id -> (timestamp, weight) of the latest weight of every user in the segments """
+        latest_by_user = dict()
+        for name in names:
+            for user_id, (timestamp, weight) in iteritems(self.segments[name]['latest_by_user']):
+                user_id = int(user_id)
+                if user_id not in latest_by_user or latest_by_user[user_id][0] <= timestamp:
+                    latest_by_user[user_id] = (timestamp, weight)
+        return latest_by_user
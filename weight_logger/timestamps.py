@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Weights are logged with the time as integer seconds since epoch (UTC) and the offset of the local time from UTC (in
+seconds) at the moment of logging. The local (naive) datetime is only needed at the edges - FitBit expects the local
+date and time of the weight and the web server shows it - and is always calculated from these two values, so
+comparisons and sorting stay integer based and the hour repeated when DST ends doesn't produce equal timestamps.
+"""
+
+import calendar
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def datetime_to_timestamp(date):
+    """ Converts a (naive) datetime into seconds since epoch """
+    return (date - EPOCH).total_seconds()
+
+
+def timestamp_to_datetime(timestamp):
+    """ Converts seconds since epoch back into a (naive) datetime """
+    return EPOCH + timedelta(seconds=float(timestamp))
+
+
+def get_utc_offset(timestamp):
+    """ Returns the offset of the local time from UTC in seconds at the given timestamp """
+    return calendar.timegm(time.localtime(timestamp)) - int(timestamp)
+
+
+def now():
+    """ Returns the current (timestamp, utc_offset) """
+    timestamp = int(time.time())
+    return timestamp, get_utc_offset(timestamp)
+
+
+def to_local_datetime(timestamp, utc_offset):
+    """ Returns the (naive) local datetime of a timestamp logged with the given UTC offset """
+    return EPOCH + timedelta(seconds=timestamp + utc_offset)
+
+
+def from_local_datetime(date, utc_offset=None):
+    """
+    Converts a (naive) local datetime to (timestamp, utc_offset)
+    @type date: datetime.datetime
+    @param date: local date and time
+    @type utc_offset: int
+    @param utc_offset: (optional) offset of the date from UTC in seconds, the offset of the local timezone at that date
+                       is used when not provided (a date in the hour repeated when DST ends is ambiguous)
+    """
+    if utc_offset is None:
+        timestamp = int(time.mktime(date.timetuple()))
+        utc_offset = get_utc_offset(timestamp)
+    else:
+        timestamp = int(datetime_to_timestamp(date)) - utc_offset
+    return timestamp, utc_offset
+
+
+def format_local(timestamp, utc_offset, date_format):
+    """ Formats the local date and time of a timestamp """
+    return to_local_datetime(timestamp, utc_offset).strftime(date_format)
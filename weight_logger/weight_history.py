@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+
+from weight_logger.timestamps import datetime_to_timestamp, timestamp_to_datetime
+
+SECONDS_IN_DAY = 24 * 60 * 60
+SECONDS_IN_WEEK = 7 * SECONDS_IN_DAY
+FIRST_MONDAY_OFFSET = 4 * SECONDS_IN_DAY  # 1970-01-01 was a Thursday, weeks are counted from Monday 1970-01-05
+
+
+class WeightHistory:
+    """
+    Columnar representation of the weight log. Each column is a NumPy array and row N of every column describes the
+    same weight entry, so all of the queries bellow are vectorized instead of looping over weight dicts.
+
+    Entries are ordered by `timestamp` (UTC), the analytics are calculated in the local time of every entry
+    (`local_timestamp`) so days and weeks start at local midnight.
+    """
+
+    def __init__(self, weights):
+        """
+        @type weights: list(dict)
+        @param weights: weight entries as stored by the WeightLogger
+        """
+        self.user_id = numpy.array([w['user_id'] for w in weights], dtype=numpy.int32)
+        self.weight = numpy.array([w['weight'] for w in weights], dtype=numpy.float64)
+        self.timestamp = numpy.array([w['timestamp'] for w in weights], dtype=numpy.int64)
+        self.utc_offset = numpy.array([w['utc_offset'] for w in weights], dtype=numpy.int64)
+        self.local_timestamp = self.timestamp + self.utc_offset
+        self.synced = numpy.array([w.get('synced', False) for w in weights], dtype=numpy.bool_)
+
+    def __len__(self):
+        return self.user_id.size
+
+    def user_ids(self):
+        """ Returns a sorted array of all user ids that have logged weight """
+        return numpy.unique(self.user_id)
+
+    def latest_indices_by_user(self):
+        """ Returns a dict of user_id -> row index of the latest weight entry of that user """
+        if not len(self):
+            return {}
+        # Sort by user and then by time, the last row of every user group is the latest entry
+        order = numpy.lexsort((self.timestamp, self.user_id))
+        sorted_users = self.user_id[order]
+        last_of_group = numpy.append(sorted_users[1:] != sorted_users[:-1], True)
+        return dict(zip(sorted_users[last_of_group].tolist(), order[last_of_group].tolist()))
+
+    def unsynced_indices(self):
+        """ Returns row indices of all entries not yet synchronised """
+        return numpy.flatnonzero(~self.synced)
+
+    def user_series(self, user_id, since=None):
+        """
+        Returns time sorted (local timestamps, weights) arrays of a single user
+        @type user_id: int
+        @param user_id: user to get the weight series for
+        @type since: datetime.datetime
+        @param since: (optional) only include entries logged on or after this (local) date
+        """
+        mask = self.user_id == user_id
+        if since is not None:
+            mask &= self.local_timestamp >= datetime_to_timestamp(since)
+        order = numpy.argsort(self.timestamp[mask], kind='mergesort')
+        return self.local_timestamp[mask][order], self.weight[mask][order]
+
+    def moving_average(self, user_id, window=7, since=None):
+        """
+        Returns a list of (datetime, average) tuples of the trailing moving average over the last `window` entries
+        """
+        timestamps, weights = self.user_series(user_id, since)
+        if window < 1 or weights.size < window:
+            return []
+        averages = numpy.convolve(weights, numpy.ones(window) / window, mode='valid')
+        return [
+            (timestamp_to_datetime(timestamp), round(float(average), 2))
+            for timestamp, average in zip(timestamps[window - 1:], averages)
+        ]
+
+    def trend_slope(self, user_id, since=None):
+        """ Returns the least squares weight trend of a user in weight units per day (None if not enough data) """
+        timestamps, weights = self.user_series(user_id, since)
+        if weights.size < 2 or timestamps[-1] == timestamps[0]:
+            return None
+        days = (timestamps - timestamps[0]) / float(SECONDS_IN_DAY)
+        slope, _ = numpy.polyfit(days, weights, 1)
+        return float(slope)
+
+    def weekly_aggregates(self, user_id, since=None):
+        """ Returns a list of dicts with the weight count, mean, min and max of a user for every week (from Monday) """
+        timestamps, weights = self.user_series(user_id, since)
+        if not weights.size:
+            return []
+        weeks = numpy.floor((timestamps - FIRST_MONDAY_OFFSET) / SECONDS_IN_WEEK).astype(numpy.int64)
+        # Entries are time sorted so every week is a contiguous block
+        week_starts = numpy.flatnonzero(numpy.append(True, weeks[1:] != weeks[:-1]))
+        counts = numpy.diff(numpy.append(week_starts, weights.size))
+        sums = numpy.add.reduceat(weights, week_starts)
+        minimums = numpy.minimum.reduceat(weights, week_starts)
+        maximums = numpy.maximum.reduceat(weights, week_starts)
+        return [
+            {
+                'week_start': timestamp_to_datetime(week * SECONDS_IN_WEEK + FIRST_MONDAY_OFFSET),
+                'count': int(count),
+                'mean': round(float(total) / count, 2),
+                'min': round(float(minimum), 2),
+                'max': round(float(maximum), 2),
+            }
+            for week, count, total, minimum, maximum in zip(weeks[week_starts], counts, sums, minimums, maximums)
+        ]
+
+    def user_summary(self, user_id, window=7, since=None):
+        """ Returns all the analytics of a single user in a single dict """
+        timestamps, weights = self.user_series(user_id, since)
+        summary = {
+            'user_id': int(user_id),
+            'entries': int(weights.size),
+            'latest_weight': round(float(weights[-1]), 2) if weights.size else None,
+            'latest_date_logged': timestamp_to_datetime(timestamps[-1]) if weights.size else None,
+            'trend_per_day': self.trend_slope(user_id, since),
+            'moving_average': self.moving_average(user_id, window, since),
+            'weekly': self.weekly_aggregates(user_id, since),
+        }
+        return summary
@@ -1,193 +1,421 @@
 # -*- coding: utf-8 -*-
 
-import csv
 import logging
+import os
 import os.path
 from collections import defaultdict
-from datetime import datetime
 from inspect import getsourcefile
+from threading import Lock
 
 from six import iteritems
 
-from config import DATETIME_FORMAT, ALLOWED_WEIGHT_FLUCTUATION_KG, WEIGHT_LOG_LOCATION, UNITS
+from config import (
+    ALLOWED_WEIGHT_FLUCTUATION_KG, FITBIT_SYNC_ENABLED, UNITS, WEIGHT_LOG_LOCATION, WEIGHT_LOG_SEGMENTS_LOCATION
+)
+from weight_logger.locking import FileLock, ReadWriteLock, reads, writes
+from weight_logger.segments import (
+    LOG_HEADER_COLUMNS, SegmentManifest, WeightLogSegment, format_weight, format_weight_row, get_segment_name,
+    parse_weight_lines, parse_weight_row
+)
+from weight_logger.timestamps import now
+from weight_logger.weight_history import WeightHistory
 
 WEIGHT_UNITS = 'kg' if UNITS == 'METRIC' else 'lbs'
 
 
-def get_csv_file_options():
-    return {
-        'delimiter': ',',
-        'quotechar': '"',
-        'quoting': csv.QUOTE_MINIMAL
-    }
-
-
-def format_weight(weight):
-    return '{:.2f}'.format(weight)
+def get_weight_key(weight_data):
+    """ Returns the key identifying a logged weight (user, time and weight) """
+    return '{}__{}__{}'.format(weight_data['user_id'], weight_data['timestamp'], format_weight(weight_data['weight']))
+
+
+def assign_user_id_by_weight(weight, latest_weight_by_user):
+    """
+    Determines which user the weight belongs to based on the latest logged weight of every user
+    @type weight: float
+    @param weight: weight to assign
+    @type latest_weight_by_user: dict
+    @param latest_weight_by_user: user_id -> latest logged weight of that user
+    @return (int) user id of the closest user or a new user id if the weight exceeds the allowed fluctuation
+    """
+    if not latest_weight_by_user:
+        return 1  # No users have logged their weight - assume it's the first user
+    # Get what is the smallest weight difference and which user it belongs to
+    user_id, smallest_difference = min(
+        ((uid, abs(user_weight - weight)) for uid, user_weight in iteritems(latest_weight_by_user)),
+        key=lambda dbu: dbu[1]
+    )
+    if smallest_difference > ALLOWED_WEIGHT_FLUCTUATION_KG:
+        # Difference exceeds the maximum allowed weight fluctuation. This means a new user has logged their weight.
+        return max(latest_weight_by_user.keys()) + 1
+    return user_id
 
 
 base_file = os.path.abspath(getsourcefile(lambda: 0))
-base_file_location = base_file[:len(base_file)-7]
+base_file_location = os.path.dirname(os.path.dirname(base_file))  # Project root, one level above this package
 
 
 class WeightLogger:
+    """
+    Weight log split into monthly segments (see weight_logger.segments). Only the segments needed for logging and
+    synchronisation are kept in memory - the segment of the current month and, while FitBit synchronisation is enabled,
+    every segment with weights that are not synchronised yet. Queries of the whole history read the other segments on
+    demand.
+    """
+
+    weight_log_directory = os.path.join(base_file_location, WEIGHT_LOG_SEGMENTS_LOCATION)
+    legacy_weight_log_file = os.path.join(base_file_location, WEIGHT_LOG_LOCATION)
+    log_header_columns = LOG_HEADER_COLUMNS
+
+    _process_weight_line = staticmethod(parse_weight_row)
+    _format_weight_data_as_file_row = staticmethod(format_weight_row)
+
+    def __init__(self, sync_enabled=FITBIT_SYNC_ENABLED):
+        """
+        @type sync_enabled: bool
+        @param sync_enabled: keep segments with unsynchronised weights in memory and uncompressed
+        """
+        if not os.path.isdir(self.weight_log_directory):
+            try:
+                os.makedirs(self.weight_log_directory)
+            except OSError:
+                # Another instance (thread or process) created it in the meantime
+                if not os.path.isdir(self.weight_log_directory):
+                    raise
+        # Reads and writes of the weights in memory are guarded by the read/write lock, writes of the segments and the
+        # manifest by the file lock (shared with other WeightLogger instances and processes)
+        self._lock = ReadWriteLock()
+        self._file_lock = FileLock(os.path.join(self.weight_log_directory, 'weight_log'))
+        self.sync_enabled = sync_enabled
+        self._manifest = SegmentManifest(self.weight_log_directory)
+        self._segments = dict()
+        self._weights = None
+        self._history = None
+        self._full_history = None
+        self._unsynced_by_user = defaultdict(list)
+
+        logging.info('[WL] Attempting to read weights from the weight log')
+        with self._file_lock:
+            if not self._manifest.exists():
+                self._create_manifest()
+            self.refresh()
+            self._compact()
+        logging.info('[WL] Found {} weight entries in {} loaded out of {} segments'.format(
+            len(self.weights), sum(1 for segment in self._segments.values() if segment.loaded), len(self._segments))
+        )
 
-    weight_log_data_file = os.path.join(base_file_location, WEIGHT_LOG_LOCATION)
-    log_header_columns = ['user_id', 'weight', 'datetime', 'synced']
+    def _get_segment(self, name):
+        if name not in self._segments:
+            self._segments[name] = WeightLogSegment(self.weight_log_directory, name)
+        return self._segments[name]
 
-    @staticmethod
-    def _process_weight_line(weight_line):
-        if not weight_line or len(weight_line) != 4:
+    def _create_manifest(self):
+        """ Creates the manifest from the segments on disk or by splitting the weight log of older versions """
+        segment_names = set(
+            file_name.split('.')[0] for file_name in os.listdir(self.weight_log_directory)
+            if file_name.endswith('.csv') or file_name.endswith('.csv.gz')
+        )
+        if segment_names:
+            logging.info('[WL] Weight log manifest not found, describing {} segments'.format(len(segment_names)))
+            for name in segment_names:
+                segment = self._get_segment(name)
+                self._manifest.update(name, segment.read(), segment.is_compressed())
+            self._manifest.store()
             return
-        weight_data = {
-            'user_id': int(weight_line[0]),
-            'weight': round(float(weight_line[1]), 2),
-            'date_logged': datetime.strptime(weight_line[2], DATETIME_FORMAT),
-            'synced': weight_line[3] == 'True',
-        }
-        return weight_data
-
-    @staticmethod
-    def _format_weight_data_as_file_row(weight_data):
-        return [
-            weight_data['user_id'],
-            format_weight(weight_data['weight']),
-            weight_data['date_logged'].strftime(DATETIME_FORMAT),
-            weight_data.get('synced', False)
-        ]
-
-    def __init__(self):
-        self.weights = self._read_all_weights()
-
-    def _create_new_weight_log(self):
-        logging.info('[WL] Creating new weight log')
-        weight_log = open(self.weight_log_data_file, "w")
-        weight_log.write(','.join(self.log_header_columns) + '\n')
-        weight_log.close()
-
-    def _read_all_weights(self):
-        logging.info('[WL] Attempting to read weights from log file')
 
         weights = list()
-
-        if not os.path.isfile(self.weight_log_data_file):
-            logging.info('[WL] Weight log file not found')
-            self._create_new_weight_log()
-            return weights
-
-        with open(self.weight_log_data_file) as weight_log:
-            weight_reader = csv.reader(weight_log, **get_csv_file_options())
-            header = True
-            for file_line in weight_reader:
-                if header:
-                    header = False
-                    continue
-
-                # Process line to get the stored weight data
-                processed_weight_line = self._process_weight_line(file_line)
-                if processed_weight_line:
-                    weights.append(processed_weight_line)
-        weight_log.close()
-
-        logging.info('[WL] Found {} weight entries'.format(len(weights)))
-        return weights
-
-    def _add_weight(self, weight_data):
-        self.weights.append(weight_data)
+        if os.path.isfile(self.legacy_weight_log_file):
+            with open(self.legacy_weight_log_file, 'rb') as weight_log:
+                weights = parse_weight_lines(weight_log.read(), skip_header=True)
+        if weights:
+            logging.info('[WL] Splitting {} weights of the weight log into monthly segments'.format(len(weights)))
+            weights_by_segment = defaultdict(list)
+            for weight_data in sorted(weights, key=lambda w: w['timestamp']):
+                weights_by_segment[get_segment_name(weight_data['timestamp'])].append(weight_data)
+            for name, segment_weights in iteritems(weights_by_segment):
+                segment = self._get_segment(name)
+                segment.weights = segment_weights
+                self._store_segment(segment)
+                segment.unload()
+        self._manifest.store()
+        if weights:
+            # Keep the old weight log as a backup, it is not read again
+            os.rename(self.legacy_weight_log_file, '{}.migrated'.format(self.legacy_weight_log_file))
+
+    def _is_hot(self, name):
+        """ Checks if a segment is kept in memory """
+        if name == get_segment_name(now()[0]):
+            return True
+        return self.sync_enabled and self._manifest.segments.get(name, {}).get('unsynced', 0) > 0
+
+    def _should_compress(self, name, weights):
+        """ Segments of past months are compressed once all of their weights are synchronised """
+        if name >= get_segment_name(now()[0]):
+            return False
+        return not self.sync_enabled or all(weight_data['synced'] for weight_data in weights)
+
+    def _store_segment(self, segment):
+        """ Writes a loaded segment and updates its manifest entry (the manifest has to be stored by the caller) """
+        segment.weights.sort(key=lambda w: w['timestamp'])
+        compressed = self._should_compress(segment.name, segment.weights)
+        segment.store(compressed)
+        self._manifest.update(segment.name, segment.weights, compressed)
+
+    def _compact(self):
+        """ Compresses the segments that are no longer needed for logging or synchronisation and unloads them """
+        compacted = 0
+        for name, description in sorted(iteritems(self._manifest.segments)):
+            if description['compressed'] or self._is_hot(name):
+                continue
+            segment = self._get_segment(name)
+            if not segment.loaded:
+                segment.load()
+            if self._should_compress(name, segment.weights):
+                self._store_segment(segment)
+                compacted += 1
+            segment.unload()
+        if compacted:
+            logging.info('[WL] Compacted {} weight log segments'.format(compacted))
+            self._manifest.store()
+            self._on_weights_changed()
+
+    def _on_weights_changed(self):
+        self._weights = None
+        self._history = None
+        self._full_history = None
+        self._build_unsynced_index(self.weights)
+
+    def _build_unsynced_index(self, weights):
+        self._unsynced_by_user = defaultdict(list)
+        for weight in weights:
+            if not weight['synced']:
+                self._unsynced_by_user[weight['user_id']].append(weight)
+
+    @property
+    def weights(self):
+        """ Weights of the segments currently in memory """
+        if self._weights is None:
+            self._weights = [
+                weight_data for name in sorted(self._segments) if self._segments[name].loaded
+                for weight_data in self._segments[name].weights
+            ]
+        return self._weights
+
+    @writes
+    def refresh(self):
+        """
+        Brings the weights in memory up to date with the weight log. Segments needed for logging and synchronisation
+        are loaded, only lines appended to them since the last read are processed and a segment is only read again if
+        it was rewritten. Segments that are no longer needed are unloaded.
+        """
+        changed = False
+        if self._manifest.reload():
+            self._full_history = None
+        for name in self._manifest.segments:
+            segment = self._get_segment(name)
+            if not self._is_hot(name):
+                if segment.loaded:
+                    segment.unload()
+                    changed = True
+                continue
+            appended = segment.read_appended() if segment.loaded else None
+            if appended is None:
+                logging.info('[WL] Loading weight log segment {}'.format(name))
+                segment.load()
+            if appended is None or appended:
+                changed = True
+        if changed:
+            self._on_weights_changed()
+
+    @reads
+    def get_history(self):
+        """ Returns the columnar (NumPy backed) representation of the weights currently in memory """
+        if self._history is None:
+            self._history = WeightHistory(self.weights)
+        return self._history
+
+    @reads
+    def get_all_weights(self):
+        """ Returns all weights of the weight log, segments that are not in memory are read (and not kept) """
+        all_weights = list()
+        for name in sorted(self._manifest.segments):
+            segment = self._get_segment(name)
+            all_weights.extend(segment.weights if segment.loaded else segment.read())
+        return all_weights
+
+    @reads
+    def get_full_history(self):
+        """
+        Returns the columnar representation of all weights of the weight log (for queries of the whole history). Only
+        the columnar representation is kept until the weights change, not the weights of the segments read for it.
+        """
+        if self._full_history is None:
+            self._full_history = WeightHistory(self.get_all_weights())
+        return self._full_history
 
     def _create_single_weight_log_entry(self, weight_data):
-        self._add_weight(weight_data)
         logging.info(
             "[WL] Writing weight log entry for user id {} ({} {})".format(
                 weight_data['user_id'], weight_data['weight'], WEIGHT_UNITS
             )
         )
-        with open(self.weight_log_data_file, 'a') as weight_log:
-            csv_writer = csv.writer(weight_log, **get_csv_file_options())
-            csv_writer.writerow(self._format_weight_data_as_file_row(weight_data))
-        weight_log.close()
-
-    def log_weight(self, weight):
+        segment = self._get_segment(get_segment_name(weight_data['timestamp']))
+        if not segment.loaded:
+            segment.load()
+        if segment.is_compressed():
+            # A weight logged with the time of a past month, the segment is written uncompressed again
+            segment.weights.append(weight_data)
+            self._store_segment(segment)
+        else:
+            segment.append(weight_data)
+            self._manifest.update(segment.name, segment.weights, compressed=False)
+        self._manifest.store()
+        self._on_weights_changed()
+
+    @writes
+    def log_weight(self, weight, timestamp=None, utc_offset=None):
+        """
+        Logs a new weigh-in
+        @type weight: float
+        @param weight: weight in kg
+        @type timestamp: int
+        @param timestamp: (optional) seconds since epoch (UTC) the weight was measured at, defaults to now
+        @type utc_offset: int
+        @param utc_offset: (optional) offset of the local time from UTC in seconds at the time of the weigh-in
+        """
         logging.info("Weight logging for weight {:.2f}, started (WL)".format(weight))
-        self._create_single_weight_log_entry({
-            'user_id': self.determine_user_id_by_weight(weight),
-            'weight': weight,
-            'date_logged': datetime.now(),
-            'synced': False
-        })
-
+        if timestamp is None or utc_offset is None:
+            timestamp, utc_offset = now()
+        with self._file_lock:
+            # Catch up with entries logged elsewhere so the user is determined from all weights and the file offsets
+            # stay in line with the segments
+            self.refresh()
+            self._create_single_weight_log_entry({
+                'user_id': self.determine_user_id_by_weight(weight),
+                'weight': weight,
+                'timestamp': timestamp,
+                'utc_offset': utc_offset,
+                'synced': False
+            })
+            self._compact()
+
+    @reads
     def determine_user_id_by_weight(self, weight):
         logging.info(
             "[WL] Searching user by weight (allowed fluctuation {:.2f} {}.)".format(
                 ALLOWED_WEIGHT_FLUCTUATION_KG, WEIGHT_UNITS
             )
         )
-        latest_weight_by_user = self.get_latest_weights_by_user()
-        if not latest_weight_by_user:
-            return 1  # No users have logged their weight - assume it's the first user
-        differences_by_user = list()
-        for user_id, user_weight_data in iteritems(latest_weight_by_user):
-            user_weight = user_weight_data.get('weight', 0.0)
-            weight_difference = abs(user_weight - weight)
-            differences_by_user.append((user_id, weight_difference))
-        differences_by_user.sort(key=lambda dbu: dbu[1])  # Sort by smallest difference
-        # Get what is the smallest weight difference and which user it belongs to
-        user_id, smallest_difference = differences_by_user[0]
-        if smallest_difference > ALLOWED_WEIGHT_FLUCTUATION_KG:
-            # Difference exceeds the maximum allowed weight fluctuation. This means a new user has
-            # logged their weight.
-            maximum_user_id = max(latest_weight_by_user.keys())
-            return maximum_user_id + 1
+        latest_weight_by_user = {
+            user_id: user_weight_data.get('weight', 0.0)
+            for user_id, user_weight_data in iteritems(self.get_latest_weights_by_user())
+        }
+        user_id = assign_user_id_by_weight(weight, latest_weight_by_user)
         logging.info("[WL] Weight assigned to user ID: {}".format(user_id))
         return user_id
 
+    @reads
     def get_weights_by_user(self):
         weights_by_user = defaultdict(lambda: list())
-        for weight in self.weights:
+        for weight in self.get_all_weights():
             weights_by_user[weight['user_id']].append(weight)
         return weights_by_user
 
+    @reads
     def get_latest_weights_by_user(self):
+        """
+        Returns a dict of user_id -> latest weight data of that user. The latest weights of segments that are not in
+        memory are taken from the manifest, they only contain the user id, weight and timestamp.
+        """
         logging.info("[WL] Getting latest weights by user")
 
-        weights_by_user = {}
-        for user_id, user_weights in iteritems(self.get_weights_by_user()):
-            user_weights.sort(key=lambda w: w['date_logged'], reverse=True)
-            weights_by_user[user_id] = user_weights[0]
+        weights_by_user = {
+            user_id: self.weights[index] for user_id, index in iteritems(self.get_history().latest_indices_by_user())
+        }
+        unloaded_segments = [name for name in self._manifest.segments if not self._get_segment(name).loaded]
+        for user_id, (timestamp, weight) in iteritems(self._manifest.get_latest_weights_by_user(unloaded_segments)):
+            if user_id not in weights_by_user or weights_by_user[user_id]['timestamp'] < timestamp:
+                weights_by_user[user_id] = {'user_id': user_id, 'weight': weight, 'timestamp': timestamp}
 
         logging.info("[WL] Found {} users with logged weight".format(len(weights_by_user)))
         return weights_by_user
 
+    @reads
+    def get_unsynced_weight_data_by_user(self):
+        """ Returns a dict of user_id -> list of weights not yet synchronised, read from the unsynced index """
+        return {user_id: list(weights) for user_id, weights in iteritems(self._unsynced_by_user) if weights}
+
+    @reads
     def get_unsynced_weight_data(self):
         logging.info("[WL] Getting unsynced weight data")
-        unsynced_data = [weight for weight in self.weights if not weight['synced']]
+        unsynced_data = [weight for weights in self._unsynced_by_user.values() for weight in weights]
         logging.info("[WL] Found {} unsynced entries".format(len(unsynced_data)))
         return unsynced_data
 
+    @writes
     def update_weight_sync_status(self, synced_weights):
-        def generate_weight_identifying_key(single_weight_data):
-            return '{}__{}__{}'.format(
-                single_weight_data['user_id'],
-                single_weight_data['date_logged'].strftime(DATETIME_FORMAT),
-                single_weight_data['weight']
-            )
-
         logging.info("[WL] Attempting sync status update of {} weights".format(len(synced_weights)))
-        keys_updated = [generate_weight_identifying_key(synced_weight) for synced_weight in synced_weights]
+        keys_updated = set(get_weight_key(synced_weight) for synced_weight in synced_weights)
         weights_updated = 0
-        for weight in self.weights:
-            if generate_weight_identifying_key(weight) in keys_updated:
-                weight['synced'] = True
-                weights_updated += 1
-        if weights_updated > 0:
-            self.store_all_weights()
+        with self._file_lock:
+            self.refresh()  # Don't drop weights logged elsewhere when the segments are rewritten
+            segments_updated = set()
+            # Only unsynced weights can change their sync status so there's no need to look through all of the weights
+            for user_id in set(synced_weight['user_id'] for synced_weight in synced_weights):
+                still_unsynced = list()
+                for weight in self._unsynced_by_user.get(user_id, []):
+                    if get_weight_key(weight) in keys_updated:
+                        weight['synced'] = True
+                        weights_updated += 1
+                        segments_updated.add(get_segment_name(weight['timestamp']))
+                    else:
+                        still_unsynced.append(weight)
+                self._unsynced_by_user[user_id] = still_unsynced
+            if weights_updated > 0:
+                # Only the segments of the updated weights are rewritten
+                for name in segments_updated:
+                    self._store_segment(self._segments[name])
+                self._manifest.store()
+                self._history = None
+                self._full_history = None
+                self._compact()
         logging.info("[WL] Updated sync status for {} out of {} weights".format(weights_updated, len(synced_weights)))
 
-    def store_all_weights(self):
-        logging.info("[WL] Storing {} weights currently in memory".format(len(self.weights)))
-        with open(self.weight_log_data_file, 'w') as weight_log:
-            csv_writer = csv.writer(weight_log, **get_csv_file_options())
-            csv_writer.writerow(self.log_header_columns)
-            for weight in self.weights:
-                csv_writer.writerow(self._format_weight_data_as_file_row(weight))
-        weight_log.close()
+    @writes
+    def add_weights(self, weights):
+        """
+        Adds multiple weight entries, every affected segment is written once
+        @type weights: list(dict)
+        @param weights: weight entries (with user ids already assigned) to add
+        """
+        if not weights:
+            return
+        logging.info("[WL] Adding {} weight entries".format(len(weights)))
+        weights_by_segment = defaultdict(list)
+        for weight_data in weights:
+            weights_by_segment[get_segment_name(weight_data['timestamp'])].append(weight_data)
+        with self._file_lock:
+            self.refresh()  # Don't drop weights logged elsewhere when the segments are rewritten
+            for name, segment_weights in sorted(iteritems(weights_by_segment)):
+                segment = self._get_segment(name)
+                if not segment.loaded:
+                    segment.load()
+                segment.weights.extend(segment_weights)
+                self._store_segment(segment)
+                if not self._is_hot(name):
+                    segment.unload()
+            self._manifest.store()
+            self._on_weights_changed()
+            self._compact()
+
+
+shared_weight_logger = None
+shared_weight_logger_lock = Lock()
+
+
+def get_weight_logger():
+    """ Returns the WeightLogger shared by all threads of this process, creating it on first use """
+    global shared_weight_logger
+    with shared_weight_logger_lock:
+        if shared_weight_logger is None:
+            shared_weight_logger = WeightLogger()
+    return shared_weight_logger
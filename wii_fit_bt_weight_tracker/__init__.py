@@ -1 +1 @@
-from . import tracker
+# Submodules are not imported here so that the pipeline and process modules can be imported without D-Bus and xwiimote
@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+"""
+Weigh-in pipeline.
+
+A weigh-in flows through the following stages:
+    source (raw board samples) -> calibrate -> decimate -> stabilise -> unit convert -> sinks
+
+Sample stages (calibrate, decimate, stabilise) run in the measurement thread one sample at a time, a stage returns None
+until it has an output for the next stage. Once the stabilise stage outputs a reading it is handed over to the
+publishing thread which runs the reading stages (unit convert) and passes the reading to every sink. Every sink runs in
+its own thread behind a bounded queue so a slow sink never holds up measuring. While the queue of a sink is full,
+optional sinks (broker, file, HTTP) drop the weigh-in and required sinks (weight log, tracker process queue) hold up
+publishing until there is room, so the weight log never loses a weigh-in.
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import time
+from collections import defaultdict
+from threading import Lock, Thread
+
+import numpy
+from six.moves import queue
+from six.moves.urllib.request import Request, urlopen
+
+from config import UNITS, DATETIME_FORMAT, WEIGH_IN_FILE_SINK_LOCATION, WEIGH_IN_HTTP_SINK_URL
+from weight_logger.timestamps import format_local, now
+from weight_logger.weight_logger import get_weight_logger
+from wii_fit_bt_weight_tracker.utils.estimators import create_estimator
+
+PUBLISH_QUEUE_SIZE = 10
+SINK_QUEUE_SIZE = 10
+STEP_CONSECUTIVE_SAMPLES = 10  # Samples in a row that have to agree before a step on or off the board is detected
+
+
+class StageTimings:
+    """ Collects how many items every stage processed and how long it took """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.calls = defaultdict(int)
+        self.total = defaultdict(float)
+        self.maximum = defaultdict(float)
+
+    def record(self, stage_name, seconds):
+        with self._lock:
+            self.calls[stage_name] += 1
+            self.total[stage_name] += seconds
+            self.maximum[stage_name] = max(self.maximum[stage_name], seconds)
+
+    def summary(self):
+        with self._lock:
+            return ', '.join(
+                '{} {} calls {:.3f}ms avg {:.3f}ms max'.format(
+                    name, self.calls[name], self.total[name] / self.calls[name] * 1000, self.maximum[name] * 1000
+                ) for name in sorted(self.calls)
+            )
+
+
+class Stage:
+    """ Base pipeline stage, processes a single item and returns the item for the next stage (or None) """
+
+    name = 'stage'
+
+    def reset(self):
+        """ Called at the start of every weigh-in """
+        pass
+
+    def process(self, item):
+        return item
+
+
+class CalibrationStage(Stage):
+    """ Sums the four load cell values of a sample and applies the calibration (raw values are in 1/100 kg) """
+
+    name = 'calibrate'
+
+    def __init__(self, offset_kg=0.0, scale=1.0):
+        self.offset = offset_kg * 100
+        self.scale = scale
+
+    def process(self, sample):
+        return sum(sample) * self.scale + self.offset
+
+
+class DecimationStage(Stage):
+    """
+    Reduces the samples to a fixed rate so the stages after it see the same number of samples per second regardless of
+    the event rate of the board. Samples are grouped in time buckets of 1/rate_hz seconds and a bucket is output once
+    the first sample of the next bucket arrives:
+        'block' - average of the samples in the bucket
+        'fir' - low-pass FIR filter (Hann window taps) over the averages of the latest `taps` buckets
+    """
+
+    name = 'decimate'
+    FILTERS = ('block', 'fir')
+
+    def __init__(self, rate_hz, filter_name='block', taps=4, clock=time.time):
+        if filter_name not in self.FILTERS:
+            raise ValueError("Unknown decimation filter '{}', expected one of: {}".format(
+                filter_name, ', '.join(self.FILTERS))
+            )
+        self.rate_hz = rate_hz
+        self.clock = clock
+        # Hann window without the zero end points, normalised when applied as fewer taps are used at the start
+        self.taps = numpy.hanning(taps + 2)[1:-1] if filter_name == 'fir' else numpy.ones(1)
+        self.block_averages = numpy.zeros(len(self.taps))
+        self.blocks = 0
+        self.bucket = None
+        self.bucket_total = 0.0
+        self.bucket_samples = 0
+
+    def reset(self):
+        self.block_averages[:] = 0
+        self.blocks = 0
+        self.bucket = None
+        self.bucket_total = 0.0
+        self.bucket_samples = 0
+
+    def process(self, weight):
+        bucket = int(self.clock() * self.rate_hz)
+        if bucket == self.bucket:
+            self.bucket_total += weight
+            self.bucket_samples += 1
+            return None
+
+        output = None
+        if self.bucket_samples:
+            # Newest block average first, the taps are symmetric so their order doesn't matter
+            self.block_averages[1:] = self.block_averages[:-1]
+            self.block_averages[0] = self.bucket_total / self.bucket_samples
+            self.blocks = min(self.blocks + 1, len(self.taps))
+            taps = self.taps[:self.blocks]
+            output = float(numpy.dot(taps, self.block_averages[:self.blocks]) / taps.sum())
+        self.bucket = bucket
+        self.bucket_total = weight
+        self.bucket_samples = 1
+        return output
+
+
+class StabiliseStage(Stage):
+    """
+    Waits until the weight settles and returns a (weight, spread) reading in raw units. The weight is considered stable
+    when the window is filled and its spread is bellow max_stddev. After max_time_to_measure seconds a slightly less
+    stable weight is accepted as well. The weight and spread are calculated by the selected estimator (see
+    wii_fit_bt_weight_tracker.utils.estimators). The window and max_samples are numbers of samples of the previous
+    stage, i.e. of decimated samples when the decimation stage runs before this one.
+    """
+
+    name = 'stabilise'
+
+    def __init__(self, max_stddev=30, window=600, settle_time=2, max_time_to_measure=5, max_samples=5000,
+                 estimator='mean'):
+        self.max_stddev = max_stddev
+        self.settle_time = settle_time  # Time for the user to get on to the scale
+        self.max_time_to_measure = max_time_to_measure  # How long to measure until logging weight
+        self.max_samples = max_samples
+        self.estimator = create_estimator(estimator, window)
+        self.counter = 0
+        self.measurement_start = None
+
+    def reset(self):
+        self.estimator.reset()
+        self.counter = 0
+        self.measurement_start = time.time() + self.settle_time
+
+    def process(self, weight):
+        if self.measurement_start is None:
+            self.reset()
+        if time.time() < self.measurement_start:
+            return None
+
+        self.estimator.update(weight)
+        mean, stddev = self.estimator.estimate()
+
+        if stddev < self.max_stddev and self.estimator.is_filled() and mean > 100:
+            return numpy.array((mean, stddev))
+        if self.counter > self.max_samples:
+            return numpy.array((0, 0))
+
+        time_elapsed = time.time() - self.measurement_start
+        if time_elapsed > self.max_time_to_measure and mean > 100 and stddev < self.max_stddev * 1.5:
+            return numpy.array((mean, stddev))
+
+        self.counter += 1
+        return None
+
+
+class UnitConversionStage(Stage):
+    """ Converts a raw (mean, stddev) reading to a weigh-in dict in kg and in the configured units """
+
+    name = 'unit_convert'
+
+    def process(self, reading):
+        kg, err_kg = float(reading[0]) / 100.0, float(reading[1]) / 100.0
+        weight, err, units = kg, err_kg, 'kg'
+        if UNITS != 'METRIC':
+            weight, err, units = kg * 2.2, err_kg * 2.2, 'lbs'
+        timestamp, utc_offset = now()
+        return {
+            'kg': kg,
+            'err_kg': err_kg,
+            'weight': weight,
+            'err': err,
+            'units': units,
+            'timestamp': timestamp,
+            'utc_offset': utc_offset,
+        }
+
+
+class LogWeighInStage(Stage):
+    """ Informs that the weight has been registered """
+
+    name = 'log'
+
+    def process(self, weigh_in):
+        logging.info("[BBTT] Weight registered: {:.2f}{}. +/- {:.2f}{}.".format(
+            weigh_in['weight'], weigh_in['units'], weigh_in['err'], weigh_in['units'])
+        )
+        return weigh_in
+
+
+class Sink(Stage):
+    """ Final stage receiving every weigh-in, runs in its own thread """
+
+    required = False  # Required sinks receive every weigh-in, others drop weigh-ins while they're falling behind
+
+    def process(self, weigh_in):
+        raise NotImplementedError
+
+
+class WeightLoggerSink(Sink):
+    """ Logs the weight in the weight log """
+
+    name = 'weight_logger'
+    required = True
+
+    def process(self, weigh_in):
+        get_weight_logger().log_weight(weigh_in['kg'], weigh_in['timestamp'], weigh_in['utc_offset'])
+
+
+class FileSink(Sink):
+    """ Appends every weigh-in as a line of JSON to a file """
+
+    name = 'file'
+
+    def __init__(self, path):
+        self.path = path
+
+    def process(self, weigh_in):
+        with open(self.path, 'a') as sink_file:
+            sink_file.write(json.dumps(format_weigh_in(weigh_in)) + '\n')
+
+
+class HttpSink(Sink):
+    """ POSTs every weigh-in as JSON to an URL """
+
+    name = 'http'
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def process(self, weigh_in):
+        request = Request(
+            self.url, data=json.dumps(format_weigh_in(weigh_in)).encode('utf8'),
+            headers={'Content-Type': 'application/json'}
+        )
+        urlopen(request, timeout=self.timeout).close()
+
+
+class LocalBroker:
+    """ Minimal in-process publish/subscribe broker (topics and callbacks, MQTT style) """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._subscribers = defaultdict(list)
+
+    def subscribe(self, topic, callback):
+        with self._lock:
+            self._subscribers[topic].append(callback)
+
+    def unsubscribe(self, topic, callback):
+        with self._lock:
+            if callback in self._subscribers[topic]:
+                self._subscribers[topic].remove(callback)
+
+    def publish(self, topic, message):
+        with self._lock:
+            subscribers = list(self._subscribers[topic])
+        for callback in subscribers:
+            callback(topic, message)
+
+
+broker = LocalBroker()
+
+
+class BrokerSink(Sink):
+    """ Publishes every weigh-in on a topic of the local broker """
+
+    name = 'broker'
+
+    def __init__(self, topic='wiifitboardbit/weigh_in', local_broker=broker):
+        self.topic = topic
+        self.broker = local_broker
+
+    def process(self, weigh_in):
+        self.broker.publish(self.topic, weigh_in)
+
+
+class QueueSink(Sink):
+    """ Puts every weigh-in on a (multiprocessing) queue, used to send weigh-ins from the tracker process """
+
+    name = 'queue'
+    required = True
+
+    def __init__(self, result_queue):
+        self.result_queue = result_queue
+
+    def process(self, weigh_in):
+        self.result_queue.put(weigh_in)
+
+
+def create_sinks():
+    """ Returns the sinks every weigh-in is passed to: the weight log, the local broker and the configured sinks """
+    sinks = [WeightLoggerSink(), BrokerSink()]
+    if WEIGH_IN_FILE_SINK_LOCATION:
+        sinks.append(FileSink(WEIGH_IN_FILE_SINK_LOCATION))
+    if WEIGH_IN_HTTP_SINK_URL:
+        sinks.append(HttpSink(WEIGH_IN_HTTP_SINK_URL))
+    return sinks
+
+
+def format_weigh_in(weigh_in):
+    """ Returns a JSON serializable copy of the weigh-in with the local date and time added """
+    formatted = dict(weigh_in)
+    formatted['date_logged'] = format_local(weigh_in['timestamp'], weigh_in['utc_offset'], DATETIME_FORMAT)
+    return formatted
+
+
+class _Worker:
+    """ Runs a function for every item put in its bounded queue on a daemon thread """
+
+    def __init__(self, name, function, queue_size, required=True):
+        self.name = name
+        self.required = required  # Whether put blocks while the queue is full instead of dropping the item
+        self.function = function
+        self.queue = queue.Queue(queue_size)
+        self.thread = Thread(name='[WiiFitBoardBit] Pipeline {}'.format(name), target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.function(item)
+            except Exception as exc:
+                logging.error("[BBTT] Pipeline {} failed. {}:{}".format(self.name, type(exc).__name__, exc))
+            finally:
+                self.queue.task_done()
+
+    def put(self, item, block=True):
+        """ Queues the item, blocks while the queue is full unless block is False (returns False if dropped) """
+        try:
+            self.queue.put(item, block)
+            return True
+        except queue.Full:
+            return False
+
+    def join(self):
+        self.queue.join()
+
+
+class WeighInPipeline:
+
+    def __init__(self, sample_stages, reading_stages, sinks):
+        """
+        @type sample_stages: list(Stage)
+        @param sample_stages: stages run on every board sample, the last one has to output the (mean, stddev) reading
+        @type reading_stages: list(Stage)
+        @param reading_stages: stages run on the reading in the publishing thread
+        @type sinks: list(Sink)
+        @param sinks: sinks receiving every weigh-in
+        """
+        self.sample_stages = sample_stages
+        self.reading_stages = reading_stages
+        self.timings = StageTimings()
+        self._sink_workers = [self._create_sink_worker(sink) for sink in sinks]
+        self._publisher = _Worker('publish', self._publish, PUBLISH_QUEUE_SIZE)
+
+    def _timed(self, stage):
+        def run_stage(item):
+            start = time.time()
+            try:
+                return stage.process(item)
+            finally:
+                self.timings.record(stage.name, time.time() - start)
+        return run_stage
+
+    def _create_sink_worker(self, sink):
+        return _Worker(sink.name, self._timed(sink), SINK_QUEUE_SIZE, required=sink.required)
+
+    def add_sink(self, sink):
+        self._sink_workers.append(self._create_sink_worker(sink))
+
+    def measure(self, samples, step_off_threshold=None):
+        """
+        Runs board samples through the sample stages until a reading is available
+        @type samples: iterator
+        @param samples: board samples, (top left, top right, bottom right, bottom left) tuples
+        @type step_off_threshold: float
+        @param step_off_threshold: (optional) raw total weight below which the user is considered to have stepped off,
+                                   measuring stops without a reading when that happens
+        @return numpy.array (mean, stddev) reading in raw units or None if measuring stopped without a stable weight
+        """
+        for stage in self.sample_stages:
+            stage.reset()
+        stages = [(stage.name, stage.process) for stage in self.sample_stages]
+        samples_off_board = 0
+        for item in samples:
+            if item is None:  # No samples arrived in time
+                continue
+            if step_off_threshold is not None:
+                samples_off_board = samples_off_board + 1 if sum(item) < step_off_threshold else 0
+                if samples_off_board >= STEP_CONSECUTIVE_SAMPLES:
+                    logging.info("[BBTT] Stepped off the board before the weight was stable")
+                    return None
+            for stage_name, process in stages:
+                start = time.time()
+                item = process(item)
+                self.timings.record(stage_name, time.time() - start)
+                if item is None:
+                    break
+            else:
+                if item[0] <= 0:  # The stabilise stage gave up (max_samples) without a stable weight
+                    logging.info("[BBTT] Weight did not stabilise, no weight captured")
+                    return None
+                return item
+
+    @staticmethod
+    def wait_for_step(samples, on_board, threshold, consecutive_samples=STEP_CONSECUTIVE_SAMPLES, timeout=None):
+        """
+        Consumes samples until somebody steps on (on_board=True) or off (on_board=False) the board
+        @type threshold: float
+        @param threshold: raw total weight above which somebody is considered to be standing on the board
+        @type consecutive_samples: int
+        @param consecutive_samples: how many samples in a row have to agree to avoid reacting to a wobble
+        @type timeout: float
+        @param timeout: (optional) seconds to wait for
+        @return (bool) True if the step was detected, False on timeout
+        """
+        start = time.time()
+        agreeing_samples = 0
+        for sample in samples:
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            if sample is None:
+                continue
+            if (sum(sample) > threshold) == on_board:
+                agreeing_samples += 1
+                if agreeing_samples >= consecutive_samples:
+                    return True
+            else:
+                agreeing_samples = 0
+        return False
+
+    def measure_session(self, samples, step_threshold, idle_timeout):
+        """
+        Measures consecutive users without reconnecting the board. After every reading waits for the user to step off
+        and for the next one to step on. A user stepping off before the weight is stable (or a weight that doesn't
+        stabilise) yields no reading. The session ends when nobody steps on (or off) for idle_timeout seconds.
+        @type samples: iterator
+        @param samples: board samples, None has to be yielded periodically while no samples arrive
+        @return generator of numpy.array (mean, stddev) readings in raw units
+        """
+        while self.wait_for_step(samples, True, step_threshold, timeout=idle_timeout):
+            reading = self.measure(samples, step_off_threshold=step_threshold)
+            if reading is not None:
+                yield reading
+            if not self.wait_for_step(samples, False, step_threshold, timeout=idle_timeout):
+                return
+
+    def publish(self, reading):
+        """ Hands the reading over to the publishing thread, blocks while the publishing queue is full """
+        self._publisher.put(reading)
+
+    def _publish(self, reading):
+        for stage in self.reading_stages:
+            reading = self._timed(stage)(reading)
+            if reading is None:
+                return
+        self.dispatch(reading)
+
+    def dispatch(self, weigh_in):
+        """
+        Passes a finished weigh-in (e.g. received from the tracker process) straight to every sink, blocks while the
+        queue of a required sink is full
+        """
+        for worker in self._sink_workers:
+            if not worker.put(weigh_in, block=worker.required):
+                logging.warning("[BBTT] Pipeline sink {} is falling behind, weigh-in dropped".format(worker.name))
+
+    def join(self):
+        """ Waits until all published readings have been processed by all sinks """
+        self._publisher.join()
+        for worker in self._sink_workers:
+            worker.join()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Runs Bluetooth tracking in its own process so measuring doesn't compete for the GIL with the web server and the FitBit
+synchronisation threads.
+
+The tracker process measures the weight and sends every finished weigh-in (a plain dict) over a multiprocessing queue.
+The main process receives the weigh-ins and passes them to the sinks (weight log, broker and the configured sinks), so
+the weight log is only ever written by the main process. The supervisor restarts the tracker process if it dies.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import multiprocessing
+import time
+from threading import Thread
+
+from six.moves import queue
+
+from config import TRACKER_RESTART_DELAY_SECS
+from wii_fit_bt_weight_tracker.pipeline import WeighInPipeline, create_sinks
+
+RESULT_QUEUE_SIZE = 100
+
+try:
+    # A new interpreter is started for the tracker instead of forking the threads of the main process
+    process_context = multiprocessing.get_context('spawn')
+except AttributeError:
+    process_context = multiprocessing  # Python 2 can only fork
+
+
+def run_tracker(result_queue, logging_config):
+    """ Entry point of the tracker process """
+    logging.basicConfig(**logging_config)
+    from wii_fit_bt_weight_tracker import tracker
+    tracker.main(result_queue)
+
+
+class TrackerSupervisor:
+
+    def __init__(self, logging_config):
+        """
+        @type logging_config: dict
+        @param logging_config: logging.basicConfig arguments of the tracker process
+        """
+        self.logging_config = logging_config
+        self.pipeline = WeighInPipeline(sample_stages=[], reading_stages=[], sinks=create_sinks())
+        self.process = None
+        self.result_queue = None
+        self.restarts = 0
+
+    def start(self):
+        """ Starts the tracker process and the thread receiving its weigh-ins """
+        # A process killed while writing to the queue can leave it unusable, every process gets a new queue
+        self.result_queue = process_context.Queue(RESULT_QUEUE_SIZE)
+        self.process = process_context.Process(
+            name='[WiiFitBoardBit] BT Tracking', target=run_tracker, args=(self.result_queue, self.logging_config)
+        )
+        self.process.daemon = True
+        self.process.start()
+        logging.info("[BBTS] Started Bluetooth tracking process (pid {})".format(self.process.pid))
+
+        receiver = Thread(name='[WiiFitBoardBit] BT Tracking Receiver', target=self._receive, args=(self.result_queue,))
+        receiver.setDaemon(True)
+        receiver.start()
+
+    def _receive(self, result_queue):
+        # Runs until the queue is replaced by a restart
+        while result_queue is self.result_queue:
+            try:
+                weigh_in = result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, IOError, OSError) as exc:
+                logging.error("[BBTS] Could not receive weigh-in. {}:{}".format(type(exc).__name__, exc))
+                return
+            self.pipeline.dispatch(weigh_in)
+
+    def check(self):
+        """ Restarts the tracker process if it has stopped, called periodically by the main thread """
+        if self.process.is_alive():
+            return
+        logging.error("[BBTS] Bluetooth tracking process stopped (exit code {}), restarting in {} seconds".format(
+            self.process.exitcode, TRACKER_RESTART_DELAY_SECS)
+        )
+        time.sleep(TRACKER_RESTART_DELAY_SECS)
+        self.restarts += 1
+        self.start()
+
+    def stop(self):
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
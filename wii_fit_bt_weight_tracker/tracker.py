@@ -5,42 +5,66 @@ from __future__ import absolute_import, print_function, unicode_literals
 import logging
 import select
 import time
-from datetime import datetime
-from threading import Thread
+from threading import Lock
 
 import dbus.mainloop.glib
-import numpy
 import xwiimote
 from six import iteritems
 
+from wii_fit_bt_weight_tracker.pipeline import (
+    CalibrationStage, DecimationStage, LogWeighInStage, QueueSink, StabiliseStage, UnitConversionStage, WeighInPipeline,
+    create_sinks
+)
 from wii_fit_bt_weight_tracker.utils import bluezutils
-from wii_fit_bt_weight_tracker.utils.ring_buffer import RingBuffer
 
 try:
     from gi.repository import GObject
 except ImportError:
     import gobject as GObject
 
-from weight_logger.weight_logger import WeightLogger
-
-from config import BALANCE_BOARD_MAC, UNITS
+from config import (
+    BALANCE_BOARD_MAC, DECIMATION_FILTER, DECIMATION_RATE_HZ, MULTI_USER_SESSION_ENABLED, SESSION_IDLE_TIMEOUT_SECS,
+    SESSION_STEP_THRESHOLD_KG, STABILISATION_ESTIMATOR, STABILISATION_TIMEOUT_SECS, STABILISATION_WINDOW_SECS,
+    WEIGHT_CALIBRATION_OFFSET_KG, WEIGHT_CALIBRATION_SCALE
+)
 
 MAX_DEVICE_TYPE_CHECK_RETRIES = 5
+WEIGH_IN_PIPELINE = None
+WEIGH_IN_RESULT_QUEUE = None  # Set when tracking runs in its own process, weigh-ins are sent to the main process
+DEVICE_MONITOR = None  # xwiimote device monitor, kept open between weigh-ins
+tracker_state_lock = Lock()  # Guards the module state above (pipeline and board address)
 relevant_ifaces = [bluezutils.ADAPTER_INTERFACE, bluezutils.DEVICE_INTERFACE]
 
 
-def convert_measurements_to_units(kg, err):
-    units = 'kg' if UNITS == 'METRIC' else 'lbs'
-    weight = kg
-    if UNITS != 'METRIC':
-        weight = kg * 2.2
-        err = err * 2.2
-    return weight, err, units
-
-
-def log_weight(weight):
-    wl = WeightLogger()
-    wl.log_weight(weight)
+def get_sample_stages():
+    """ Returns the stages every board sample goes through """
+    stages = [CalibrationStage(WEIGHT_CALIBRATION_OFFSET_KG, WEIGHT_CALIBRATION_SCALE)]
+    if DECIMATION_RATE_HZ:
+        stages.append(DecimationStage(DECIMATION_RATE_HZ, DECIMATION_FILTER))
+        # The window and the sample limit are numbers of decimated samples
+        window = max(int(round(STABILISATION_WINDOW_SECS * DECIMATION_RATE_HZ)), 1)
+        max_samples = max(int(round(STABILISATION_TIMEOUT_SECS * DECIMATION_RATE_HZ)), window)
+        stages.append(StabiliseStage(window=window, max_samples=max_samples, estimator=STABILISATION_ESTIMATOR))
+    else:
+        stages.append(StabiliseStage(estimator=STABILISATION_ESTIMATOR))
+    return stages
+
+
+def get_weigh_in_pipeline():
+    """ Returns the weigh-in pipeline, creating it on first use """
+    global WEIGH_IN_PIPELINE
+    with tracker_state_lock:
+        if not WEIGH_IN_PIPELINE:
+            if WEIGH_IN_RESULT_QUEUE is not None:
+                sinks = [QueueSink(WEIGH_IN_RESULT_QUEUE)]
+            else:
+                sinks = create_sinks()
+            WEIGH_IN_PIPELINE = WeighInPipeline(
+                sample_stages=get_sample_stages(),
+                reading_stages=[UnitConversionStage(), LogWeighInStage()],
+                sinks=sinks,
+            )
+    return WEIGH_IN_PIPELINE
 
 
 def get_device_type(dev, num_try=1):
@@ -60,9 +84,18 @@ def dev_is_balance_board(dev):
     return get_device_type(dev) == 'balanceboard'
 
 
+def get_device_monitor():
+    """ Returns the xwiimote device monitor, creating it on first use """
+    global DEVICE_MONITOR
+    with tracker_state_lock:
+        if DEVICE_MONITOR is None:
+            DEVICE_MONITOR = xwiimote.monitor(True, False)
+    return DEVICE_MONITOR
+
+
 def wait_for_balance_board():
     logging.info("[BBTT] Waiting for the Wii Balance Board to connect...")
-    mon = xwiimote.monitor(True, False)
+    mon = get_device_monitor()
     balance_board_dev = None
 
     while not balance_board_dev:
@@ -76,11 +109,16 @@ def wait_for_balance_board():
     return balance_board_dev
 
 
-def measurements(iface):
-    p = select.epoll.fromfd(iface.get_fd())
+def measurements(iface, timeout=-1):
+    """ Yields board samples, or None when no events arrive within the timeout (in seconds, -1 blocks) """
+    # The descriptor belongs to the interface, poll (unlike an epoll object created from it) never closes it
+    p = select.poll()
+    p.register(iface.get_fd(), select.POLLIN)
 
     while True:
-        p.poll()  # blocks
+        if not p.poll(timeout * 1000):  # blocks
+            yield None
+            continue
 
         event = xwiimote.event()
         iface.dispatch(event)
@@ -93,35 +131,6 @@ def measurements(iface):
         yield (tl, tr, br, bl)
 
 
-def average_measurements(ms, max_stddev=30):
-    weight_measurements = RingBuffer(600)
-    counter = 0
-
-    time.sleep(2)  # Wait for user to get on to the scale
-    max_time_to_measure = 5   # How long to measure until logging weight
-    measurement_start = datetime.now()
-
-    while True:
-        weight = sum(ms.next())
-
-        weight_measurements.append(weight)
-        mean = numpy.mean(weight_measurements.data)
-        stddev = numpy.std(weight_measurements.data)
-
-        # logging.info("Mean {:.2f} STDDEV {:.2f} WEIGHT {:.2f}".format(mean, stddev, weight))
-
-        if stddev < max_stddev and weight_measurements.filled and mean > 100:
-            return numpy.array((mean, stddev))
-        if counter > 5000:
-            return numpy.array((0, 0))
-
-        time_elapsed = (datetime.now() - measurement_start).seconds
-        if time_elapsed > max_time_to_measure and mean > 100 and stddev < max_stddev * 1.5:
-            return numpy.array((mean, stddev))
-
-        counter += 1
-
-
 def find_device_address():
     adapter = bluezutils.find_adapter()
     adapter_path = adapter.object_path
@@ -142,32 +151,69 @@ def find_device_address():
         return address
 
 
-def connect_balance_board():
+def disconnect_balance_board(device_path=None):
+    """
+    Disconnects the balance board, using the D-Bus path of the device from the connection event when it is known and
+    looking up the device by its address otherwise
+    """
     global BALANCE_BOARD_MAC
+    if device_path:
+        device = bluezutils.get_device(device_path)
+    else:
+        # find address of the balance board (once) and disconnect (if found).
+        with tracker_state_lock:
+            if not BALANCE_BOARD_MAC:
+                BALANCE_BOARD_MAC = find_device_address()
+            address = BALANCE_BOARD_MAC
+        if not address:
+            return
+        device = bluezutils.find_device(address)
+    if device:
+        device.Disconnect()
+
+
+def connect_balance_board(device_path=None):
     # device is something like "/sys/devices/platform/soc/3f201000.uart/tty/ttyAMA0/hci0/hci0:11/0005:057E:0306.000C"
     device = wait_for_balance_board()
 
     iface = xwiimote.iface(device)
     iface.open(xwiimote.IFACE_BALANCE_BOARD)
-
-    (kg, err) = average_measurements(measurements(iface))
-    kg /= 100.0
-    err /= 100.0
-    weight, err, units = convert_measurements_to_units(kg, err)
-
-    # Log the weight and inform that the weight has been logged.
-    logging.info("[BBTT] Weight registered: {:.2f}{}. +/- {:.2f}{}.".format(weight, units, err, units))
-    logging.info("[BBTT] Attempting to log weight")
-    weight_logging_thread = Thread(target=log_weight, args=(kg,))
-    weight_logging_thread.start()
-
-    # find address of the balance board (once) and disconnect (if found).
-    if not BALANCE_BOARD_MAC:
-        BALANCE_BOARD_MAC = find_device_address()
-    if BALANCE_BOARD_MAC:
-        device = bluezutils.find_device(BALANCE_BOARD_MAC)
-        if device:
-            device.Disconnect()
+    try:
+        pipeline = get_weigh_in_pipeline()
+        if MULTI_USER_SESSION_ENABLED:
+            measure_session(pipeline, iface, device_path)
+            return
+        reading = pipeline.measure(measurements(iface))
+    finally:
+        iface.close(xwiimote.IFACE_BALANCE_BOARD)
+
+    # Disconnect as soon as the weight is captured to save board battery and free up the adapter
+    captured_at = time.time()
+    disconnect_balance_board(device_path)
+    logging.info("[BBTT] Balance board {} disconnected {:.0f} ms after the weight was captured".format(
+        device_path or BALANCE_BOARD_MAC, (time.time() - captured_at) * 1000)
+    )
+
+    # Hand the weight over to the pipeline sinks (weight log etc.), which run on their own threads
+    if reading is not None:
+        pipeline.publish(reading)
+    logging.info("[BBTT] Pipeline stage timings: {}".format(pipeline.timings.summary()))
+
+
+def measure_session(pipeline, iface, device_path=None):
+    """ Keeps the board connected and logs consecutive users until nobody steps on the board for a while """
+    logging.info("[BBTT] Starting multi-user weigh-in session")
+    readings = pipeline.measure_session(
+        measurements(iface, timeout=1), SESSION_STEP_THRESHOLD_KG * 100, SESSION_IDLE_TIMEOUT_SECS
+    )
+    weigh_ins = 0
+    for reading in readings:
+        pipeline.publish(reading)
+        weigh_ins += 1
+        logging.info("[BBTT] Session weigh-in {} captured, waiting for the next user".format(weigh_ins))
+    disconnect_balance_board(device_path)
+    logging.info("[BBTT] Weigh-in session ended after {} weigh-ins".format(weigh_ins))
+    logging.info("[BBTT] Pipeline stage timings: {}".format(pipeline.timings.summary()))
 
 
 def property_changed(interface, changed, invalidated, path):
@@ -178,11 +224,18 @@ def property_changed(interface, changed, invalidated, path):
         # check if property "Connected" changed to "1". Does NOT check which device has connected, we only assume it
         # was the balance board
         if name == "Connected" and val == "1":
-            connect_balance_board()
+            connect_balance_board(path)
 
 
-def main():
+def main(result_queue=None):
+    """
+    Tracks balance board connections and measures the weight
+    @type result_queue: multiprocessing.Queue
+    @param result_queue: (optional) queue to send weigh-ins to instead of the sinks, when running in its own process
+    """
+    global WEIGH_IN_RESULT_QUEUE
     logging.info("Starting Bluetooth WiiFit board tracking thread (BBTT)")
+    WEIGH_IN_RESULT_QUEUE = result_queue
 
     logging.info("[BBTT] Preparing DBus")
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
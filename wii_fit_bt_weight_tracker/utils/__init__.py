@@ -1,2 +1 @@
-from . import bluezutils
-from . import ring_buffer
+# Submodules are not imported here so that the estimators can be used without D-Bus
@@ -48,3 +48,8 @@ def find_device_in_objects(objects, device_address, adapter_pattern=None):
 		return dbus.Interface(obj, DEVICE_INTERFACE)
 
 	raise Exception("Bluetooth device not found")
+
+
+def get_device(device_path):
+	bus = dbus.SystemBus()
+	return dbus.Interface(bus.get_object(SERVICE_NAME, device_path), DEVICE_INTERFACE)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming estimators of the weight and its spread over a window of the latest samples.
+
+Every estimator keeps the window in a RingBuffer. The robust estimators additionally keep the window sorted, updating it
+with a single insert and removal per sample, so the median and trimmed values don't require sorting the window.
+The spread is always expressed as a standard deviation equivalent so the same stability thresholds apply to every
+estimator.
+"""
+
+from bisect import bisect_left, insort
+
+import numpy
+
+from wii_fit_bt_weight_tracker.utils.ring_buffer import RingBuffer
+
+MAD_TO_STDDEV = 1.4826  # Scales the median absolute deviation to the standard deviation of normally distributed data
+
+
+class MeanEstimator:
+    """ Plain mean and standard deviation, kept up to date with running sums """
+
+    def __init__(self, window):
+        self.window = window
+        self.buffer = RingBuffer(window, dtype=numpy.float64)
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def is_filled(self):
+        return self.count >= self.window
+
+    def reset(self):
+        self.buffer.reset()
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def _evicted(self):
+        """ Returns the value the next append overwrites or None if the window isn't filled yet """
+        if not self.is_filled():
+            return None
+        return float(self.buffer.data[(self.buffer.index + 1) % self.window])
+
+    def update(self, value):
+        evicted = self._evicted()
+        if evicted is not None:
+            self.total -= evicted
+            self.total_squares -= evicted * evicted
+        self.buffer.append(value)
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+        return evicted
+
+    def estimate(self):
+        """ Returns (center, spread) of the samples in the window """
+        samples = min(self.count, self.window)
+        if not samples:
+            return 0.0, 0.0
+        mean = self.total / samples
+        variance = max(self.total_squares / samples - mean * mean, 0.0)
+        return mean, variance ** 0.5
+
+
+class SortedWindowEstimator(MeanEstimator):
+    """ Base of the robust estimators, keeps a sorted copy of the window """
+
+    def __init__(self, window):
+        MeanEstimator.__init__(self, window)
+        self.sorted_window = list()
+
+    def reset(self):
+        MeanEstimator.reset(self)
+        self.sorted_window = list()
+
+    def update(self, value):
+        evicted = MeanEstimator.update(self, value)
+        if evicted is not None:
+            del self.sorted_window[bisect_left(self.sorted_window, evicted)]
+        insort(self.sorted_window, float(value))
+        return evicted
+
+    def median(self):
+        samples = len(self.sorted_window)
+        middle = samples // 2
+        if samples % 2:
+            return self.sorted_window[middle]
+        return (self.sorted_window[middle - 1] + self.sorted_window[middle]) / 2.0
+
+    def estimate(self):
+        raise NotImplementedError
+
+
+class MedianEstimator(SortedWindowEstimator):
+    """ Rolling median with the scaled median absolute deviation as the spread """
+
+    def estimate(self):
+        if not self.sorted_window:
+            return 0.0, 0.0
+        median = self.median()
+        mad = numpy.median(numpy.abs(numpy.array(self.sorted_window) - median))
+        return median, float(mad) * MAD_TO_STDDEV
+
+
+class MADEstimator(SortedWindowEstimator):
+    """ Mean and standard deviation of the samples left after rejecting outliers further than `threshold` MADs """
+
+    def __init__(self, window, threshold=3.0):
+        SortedWindowEstimator.__init__(self, window)
+        self.threshold = threshold
+
+    def estimate(self):
+        if not self.sorted_window:
+            return 0.0, 0.0
+        samples = numpy.array(self.sorted_window)
+        median = self.median()
+        mad = float(numpy.median(numpy.abs(samples - median))) * MAD_TO_STDDEV
+        if mad == 0:
+            return median, 0.0
+        inliers = samples[numpy.abs(samples - median) <= self.threshold * mad]
+        return float(numpy.mean(inliers)), float(numpy.std(inliers))
+
+
+class TrimmedMeanEstimator(SortedWindowEstimator):
+    """ Mean and standard deviation of the window without the `proportion` lowest and highest samples """
+
+    def __init__(self, window, proportion=0.1):
+        SortedWindowEstimator.__init__(self, window)
+        self.proportion = proportion
+
+    def estimate(self):
+        if not self.sorted_window:
+            return 0.0, 0.0
+        trim = int(len(self.sorted_window) * self.proportion)
+        samples = numpy.array(self.sorted_window[trim:len(self.sorted_window) - trim])
+        return float(numpy.mean(samples)), float(numpy.std(samples))
+
+
+ESTIMATORS = {
+    'mean': MeanEstimator,
+    'median': MedianEstimator,
+    'mad': MADEstimator,
+    'trimmed_mean': TrimmedMeanEstimator,
+}
+
+
+def create_estimator(name, window):
+    """
+    Creates an estimator by name
+    @type name: str
+    @param name: one of ESTIMATORS
+    @type window: int
+    @param window: number of latest samples to estimate over
+    """
+    if name not in ESTIMATORS:
+        raise ValueError("Unknown estimator '{}', expected one of: {}".format(name, ', '.join(sorted(ESTIMATORS))))
+    return ESTIMATORS[name](window)
@@ -3,8 +3,9 @@ import numpy
 
 # From https://github.com/irq0/wiiscale/blob/master/scale.py
 class RingBuffer:
-	def __init__(self, length):
+	def __init__(self, length, dtype=int):
 		self.length = length
+		self.dtype = dtype
 		self.filled = False
 		self.index = 0
 		self.data = None
@@ -31,5 +32,5 @@ class RingBuffer:
 		return self.data[idx]
 
 	def reset(self):
-		self.data = numpy.zeros(self.length, dtype=numpy.int)
+		self.data = numpy.zeros(self.length, dtype=self.dtype)
 		self.index = 0